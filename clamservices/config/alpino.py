@@ -70,12 +70,51 @@ FLATURL = None
 SWITCHBOARD_FORWARD_URL = None
 FROG_FORWARD_URL = None
 
+#Alpino is single-threaded, set this to distribute the sentences of a document over multiple Alpino processes
+#(or over multiple servers from the pool, if enabled)
+ALPINO_PROCESSES = 1
+
+#Rather than starting Alpino (which loads its lexicon and disambiguation model) for every input file, the wrapper can
+#submit sentences to a pool of resident Alpino servers that is shared between all jobs of this service. If no server
+#is available, the wrapper falls back to starting Alpino itself.
+ALPINO_POOL_SIZE = 0 #number of resident Alpino servers (0 = disabled)
+ALPINO_POOL_HOST = "127.0.0.1"
+ALPINO_POOL_PORT = 42424 #port of the first server, the others use the subsequent ports
+ALPINO_POOL_DIR = None #directory for the pool state and server logs, defaults to ROOT/alpinopool
+ALPINO_POOL_STARTTIMEOUT = 300 #seconds to wait for an Alpino server to load
+ALPINO_POOL_MAXRESTARTS = 3 #consecutive failed restarts after which a server is disabled for a while
+
+#The XML output for each sentence is written directly into the zip archive. Set this to also keep the loose XML files
+#in a directory (xml_$BASENAME) in the output directory
+ALPINO_KEEP_XMLDIR = False
+
+#Time budgets (in seconds). Alpino gives up on sentences that take longer than ALPINO_SENTENCE_TIMEOUT, once the
+#job takes longer than ALPINO_JOB_TIMEOUT (0 = unlimited) all remaining sentences are skipped. Skipped sentences are
+#listed in a report ($BASENAME.timeouts.txt) and left out of the XML collection and the FoLiA document.
+ALPINO_SENTENCE_TIMEOUT = 900
+ALPINO_JOB_TIMEOUT = 0
+
+#Parses are cached per sentence (keyed on the normalised tokens and the parser options), so sentences that recur
+#(boilerplate, headers, standard phrases) are only parsed once. The cache is shared between all jobs of this service.
+ALPINO_CACHE_SIZE = 1024 #size budget of the cache in MB (0 = disabled), least recently used parses are evicted
+ALPINO_CACHE_FILE = None #defaults to ROOT/alpinocache.sqlite
+
+#The FoLiA document is serialised once, after all sentences have been converted. Set either of these to also save
+#intermediate checkpoints every so many sentences and/or seconds (0 = no checkpoints)
+ALPINO_FOLIA_CHECKPOINT_SENTENCES = 0
+ALPINO_FOLIA_CHECKPOINT_INTERVAL = 0
+
 if 'ALPINO_HOME' in os.environ:
     ALPINO_HOME = os.environ['ALPINO_HOME']
 
 #Load external configuration file
 loadconfig(__name__)
 
+if not ALPINO_POOL_DIR:
+    ALPINO_POOL_DIR = os.path.join(ROOT, "alpinopool")
+if not ALPINO_CACHE_FILE:
+    ALPINO_CACHE_FILE = os.path.join(ROOT, "alpinocache.sqlite")
+
 # ======== ENABLED FORMATS ===========
 
 class AlpinoXMLCollection(CLAMMetaData):
@@ -111,6 +150,12 @@ PROFILES = [
             removeextension='.tok',
             multi=True,
         ),
+        OutputTemplate('timeoutreport',PlainTextFormat,'Report of sentences that could not be parsed within the time budget',
+            SetMetaField('encoding','utf-8'),
+            extension='.timeouts.txt',
+            removeextension='.tok',
+            multi=True,
+        ),
     ),
     Profile(
         InputTemplate('untokinput', PlainTextFormat,"Plaintext document (untokenised)",
@@ -141,6 +186,12 @@ PROFILES = [
             removeextension='.txt',
             multi=True,
         ),
+        OutputTemplate('timeoutreport',PlainTextFormat,'Report of sentences that could not be parsed within the time budget',
+            SetMetaField('encoding','utf-8'),
+            extension='.timeouts.txt',
+            removeextension='.txt',
+            multi=True,
+        ),
     )
 ]
 
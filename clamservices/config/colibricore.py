@@ -60,9 +60,35 @@ CUSTOMHTML_INDEX = """
 
 USERS = None
 
+#Produce all requested analysis outputs from a single load of the pattern model, through the Python colibricore
+#bindings, rather than reloading the model with colibri-patternmodeller for every output. Falls back to
+#colibri-patternmodeller if the bindings are not installed.
+COLIBRI_INPROCESS = True
+
+#Input files are processed (encoded, modelled and analysed) in parallel by a bounded pool of worker processes
+COLIBRI_MAXWORKERS = 4 #0 = number of CPU cores
+COLIBRI_WORKERMEMORY = 4000 #minimum memory to reserve for building and analysing a single pattern model, in MB
+COLIBRI_MEMORY = 25000 #memory budget for all workers together, in MB, shared equally between the workers
+
+#The memory usage of every pattern model is estimated before it is built. If it exceeds the model's share of the
+#memory budget, the job is either rejected ('reject') or the model is degraded ('degrade'): indexing is disabled
+#(unless co-occurrence output requires it) and the occurrence threshold is raised until the estimate fits. Any
+#degradation is reported in the status and at the top of the statistical report. The estimate errs on the high side,
+#see estimatememory() in the wrapper.
+COLIBRI_MEMORYPOLICY = 'degrade'
+
+#Class files and encoded corpus data are cached on disk, keyed on the input data, and pattern models are cached keyed on
+#the class encoding and the parameters they were actually built with (after any degradation), so a rerun with different
+#output options skips straight to the analysis. Least recently used entries are evicted once the cache is full.
+COLIBRI_CACHE_SIZE = 10240 #size budget of the cache in MB (0 = disabled)
+COLIBRI_CACHE_DIR = None #defaults to ROOT/colibricache
+
 #Load external configuration file
 loadconfig(__name__)
 
+if not COLIBRI_CACHE_DIR:
+    COLIBRI_CACHE_DIR = os.path.join(ROOT, "colibricache")
+
 
 
 
@@ -147,6 +173,15 @@ PROFILES = [
                 extension='.npmi.csv',
                 multi=True
             )
+        ),
+        ParameterCondition(query_set=True,
+            then=OutputTemplate('query',CSVFormat,"Query results",
+                SimpleTableViewer(),
+                SetMetaField('encoding','utf-8'),
+                removeextensions=['.txt','.xml'],
+                extension='.query.csv',
+                multi=True
+            )
         )
     ),
     Profile(
@@ -224,6 +259,15 @@ PROFILES = [
                 extension='.npmi.csv',
                 multi=True
             )
+        ),
+        ParameterCondition(query_set=True,
+            then=OutputTemplate('query',CSVFormat,"Query results",
+                SimpleTableViewer(),
+                SetMetaField('encoding','utf-8'),
+                removeextensions=['.txt','.xml'],
+                extension='.query.csv',
+                multi=True
+            )
         )
     ),
     Profile(
@@ -304,6 +348,15 @@ PROFILES = [
                 extension='.npmi.csv',
                 multi=True
             )
+        ),
+        ParameterCondition(query_set=True,
+            then=OutputTemplate('query',CSVFormat,"Query results",
+                SimpleTableViewer(),
+                SetMetaField('encoding','utf-8'),
+                removeextensions=['.txt','.xml'],
+                extension='.query.csv',
+                multi=True
+            )
         )
     ),
 ]
@@ -316,6 +369,7 @@ PARAMETERS =  [
         IntegerParameter('maxlength','Maximum length', 'Maximum length of n-gram or skipgram (i.e value of n)', default=5),
         BooleanParameter('skipgrams','Skipgrams', 'Include skipgrams'),
         BooleanParameter('indexing','Indexing', 'Compute an indexed to where in the corpus the pattern is found (memory intensive!)'),
+        BooleanParameter('combine','Combined model', 'Build a single class encoding and pattern model over all input files together (named corpus.*), rather than a separate model per input file'),
     ]),
     ('Modules (pick at least one)',[
         BooleanParameter('extract','Extract patterns', 'Output a list of all patterns (ngrams, skipgrams) with their counts'),
@@ -326,7 +380,7 @@ PARAMETERS =  [
         FloatParameter('npmi','Co-occurrence (relative)', 'Compute co-occurring patterns (occuring on the same input line in the corpus data) that have a normalised mutial information higher than the specified value (-1=disabled)', default=-1),
     ]),
     ('Query',[
-        StringParameter('query','Query', 'Query the corpus for the following patterns (rather than all), should be a comma-separated list.'),
+        StringParameter('query','Query', 'Query the corpus for the following patterns (rather than all), should be a comma-separated list. Outputs the occurrence count of each pattern, and its positions in the corpus if indexing is enabled.'),
     ])
 ]
 
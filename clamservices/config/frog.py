@@ -76,9 +76,45 @@ DEBUG = False
 FLATURL = None
 SWITCHBOARD_FORWARD_URL = None
 
+# ================ Parallel processing ===============
+
+#Multiple input files are processed simultaneously by a bounded pool of workers. The number of workers is limited
+#by FROG_MAXWORKERS, the number of available CPU cores, and the available memory divided by FROG_WORKERMEMORY
+FROG_MAXWORKERS = 4 #maximum number of files processed simultaneously in a single job (0 = number of CPU cores)
+FROG_WORKERMEMORY = 1500 #estimated peak memory usage of a single Frog process (in MB, 0 = do not take memory into account)
+
+#Large plain-text documents are split into shards (at paragraph or sentence boundaries) of about this size, the shards
+#are processed in parallel and merged back into a single FoLiA document and a single columned output file
+FROG_SHARDSIZE = 5 * 1024 * 1024 #in bytes (0 = never split documents)
+
+# ================ Frog server pool ===============
+
+#Rather than starting a new Frog process (which loads all models) for every input file, the wrapper can submit
+#documents to a pool of resident Frog servers that is shared between all jobs of this service.
+#Each server takes as much memory as a normal Frog run, so the pool is disabled by default.
+FROG_POOL_SIZE = 0 #number of resident Frog servers (0 = disabled, start a Frog process per file)
+FROG_POOL_HOST = "127.0.0.1"
+FROG_POOL_PORT = 7350 #port of the first server, the others use the subsequent ports
+FROG_POOL_DIR = None #directory for the pool state and server logs, defaults to ROOT/frogpool
+FROG_POOL_STARTTIMEOUT = 300 #seconds to wait for a Frog server to load its models
+FROG_POOL_MAXRESTARTS = 3 #consecutive failed restarts after which a server is disabled for a while (falling back to a Frog process per file)
+FROG_POOL_TIMEOUT = 1800 #seconds a Frog server may remain silent on a submitted file before it is considered hung (it is restarted and the file is processed by a Frog process instead)
+
+# ================ Result cache ===============
+
+#Results are cached on disk, keyed on the input data, the selected options, the document ID and the Frog version,
+#so resubmitted documents are not processed again. Least recently used results are evicted once the cache is full.
+FROG_CACHE_SIZE = 2048 #size budget of the cache in MB (0 = disabled)
+FROG_CACHE_DIR = None #defaults to ROOT/frogcache
+
 #load external configuration file
 loadconfig(__name__)
 
+if not FROG_POOL_DIR:
+    FROG_POOL_DIR = os.path.join(ROOT, "frogpool")
+if not FROG_CACHE_DIR:
+    FROG_CACHE_DIR = os.path.join(ROOT, "frogcache")
+
 
 #The system command (Use the variables $STATUSFILE $DATAFILE $PARAMETERS $INPUTDIRECTORY $OUTPUTDIRECTORY $USERNAME)
 COMMAND = WRAPPERDIR + "/frogwrapper.py " + BINDIR + " $DATAFILE $STATUSFILE $OUTPUTDIRECTORY"
@@ -52,6 +52,13 @@ DEBUG = False
 FLATURL = None
 SWITCHBOARD_FORWARD_URL = None
 
+#spaCy runs inside the wrapper, documents are streamed through nlp.pipe() in batches of this many documents
+SPACY_BATCHSIZE = 16
+
+#Number of processes nlp.pipe() uses, each holds its own copy of the model (0 = number of CPU cores)
+SPACY_PROCESSES = 0
+SPACY_WORKERMEMORY = 1500 #estimated memory usage of a single process in MB, the number of processes is bounded by the available memory
+
 #load external configuration file
 loadconfig(__name__)
 
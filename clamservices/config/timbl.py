@@ -39,9 +39,44 @@ USERS = None #Enable this instead if you want no authentication
 
 
 DEBUG = False
+# ================ Parallel classification ===============
+
+#Test files are classified in parallel by a bounded pool of workers, each running a Timbl process that loads the
+#instance base (0 = number of CPU cores)
+TIMBL_MAXWORKERS = 4
+
+#Test files (not in ARFF format) larger than this are split into one shard per worker (at line boundaries), which are
+#classified in parallel and stitched back together (in order) into a single output file. Every shard loads the
+#instance base again, so there are no more shards than workers.
+TIMBL_SHARDSIZE = 20 * 1024 * 1024 #in bytes (0 = never split test files)
+
+# ================ Benchmark mode ===============
+
+#Grid of classifier settings compared in benchmark mode, all combinations are tried (other options are as chosen by
+#the user)
+TIMBL_BENCHMARK_GRID = [
+    ('-a', ['IB1','IG','TRIBL','IB2','TRIBL2']),
+    ('-m', ['O','M']),
+    ('-w', ['nw','gr','ig']),
+]
+TIMBL_BENCHMARK_TRAINSAMPLE = 50000 #number of training instances sampled (evenly spread over the training data)
+TIMBL_BENCHMARK_TESTSAMPLE = 5000 #number of test instances sampled (from the test data, or held out from the training data)
+TIMBL_BENCHMARK_MAXWORKERS = 4 #settings benchmarked in parallel, set to 1 for the most accurate timings
+
+# ================ Instance base cache ===============
+
+#Trained instance bases and feature weights are cached on disk, keyed on the training data and the classifier
+#options, so jobs testing against the same training data do not train again. Least recently used instance bases are
+#evicted once the cache is full.
+TIMBL_CACHE_SIZE = 4096 #size budget of the cache in MB (0 = disabled)
+TIMBL_CACHE_DIR = None #defaults to ROOT/timblcache
+
 #Load external configuration file
 loadconfig(__name__)
 
+if not TIMBL_CACHE_DIR:
+    TIMBL_CACHE_DIR = os.path.join(ROOT, "timblcache")
+
 
 
 #The system command. It is recommended you set this to small wrapper
@@ -75,11 +110,42 @@ PROFILES = [
             ChoiceParameter(id='encoding',name='Encoding',description='The character encoding of the file', choices=[('utf-8','UTF-8 (Unicode)'),('iso-8859-1','ISO-8859-1 (Latin1)'),('iso-8859-15','iso-8859-15 (Latin9)'),('ascii','ASCII')]),
             extension='test',
             multi=True,
+            optional=True,
         ),
         OutputTemplate('out', PlainTextFormat, "Classifier Output",
             CopyMetaField('encoding','traindata.encoding'),
             extension='timblout',
         ),
+        ParameterCondition(evaluate=True,
+            then=OutputTemplate('accuracy', CSVFormat, "Evaluation: accuracy",
+                SetMetaField('encoding','utf-8'),
+                extension='accuracy.csv',
+            ),
+        ),
+        ParameterCondition(evaluate=True,
+            then=OutputTemplate('classstats', CSVFormat, "Evaluation: per-class precision, recall and F-score",
+                SetMetaField('encoding','utf-8'),
+                extension='classstats.csv',
+            ),
+        ),
+        ParameterCondition(evaluate=True,
+            then=OutputTemplate('confusion', CSVFormat, "Evaluation: confusion matrix",
+                SetMetaField('encoding','utf-8'),
+                extension='confusion.csv',
+            ),
+        ),
+        ParameterCondition(benchmark=True,
+            then=OutputTemplate('benchmark', CSVFormat, "Benchmark",
+                SetMetaField('encoding','utf-8'),
+                extension='benchmark.csv',
+            ),
+        ),
+        ParameterCondition(folds_greaterthan=1,
+            then=OutputTemplate('crossvalidation', PlainTextFormat, "Cross-validation summary",
+                CopyMetaField('encoding','traindata.encoding'),
+                extension='crossvalidation.txt',
+            ),
+        ),
     ),
 ]
 
@@ -92,11 +158,14 @@ PARAMETERS =  [
         ChoiceParameter('d','Distance weighting', 'Weigh neigbours as a function of their distance', choices=[('Z','Equal weights to all'),( 'ID', 'Inverse Distance'),('IL','Inverse Linear'),('ED:2','Exponential Decay with factor 2')], paramflag='-d'),
         BooleanParameter('s', 'Exemplar Weights', 'Use exemplar weights from the input file', paramflag='-s'),
         BooleanParameter('leaveoneout', 'Leave-one-out', 'Test using leave-one-out instead of test file', paramflag='-t leave_one_out'),
+        BooleanParameter('benchmark', 'Benchmark', 'Rather than classifying the test data, compare the speed and accuracy of various algorithms, feature metrics and weightings on a sample of the data. Reports training time, classification throughput (instances/s), peak memory usage and accuracy per setting (not available for the ARFF format)', paramflag='--benchmark'),
+        IntegerParameter('folds', 'Cross-validation folds', 'Test using n-fold cross-validation on the training data (0 = disabled). The folds are trained and tested in parallel, outputs are produced per fold along with a summary of accuracy and confusion matrix (not available for the Compact and ARFF formats)', default=0, paramflag='--folds'),
     ]),
     ('Input  Format', [
         ChoiceParameter('F','Input Format','Input format for training and test files',choices=[('Compact','Compact'),('C4.5','C4.5'),('ARFF','ARFF'),('Columns','Columns'),('Tabbed','Tabbed')], default='Columns',paramflag='-F'),
     ]),
     ('Output Options', [
+        BooleanParameter('evaluate', 'Evaluate', 'Compute the accuracy, per-class precision/recall/F-score and the confusion matrix of every output, as separate CSV files. This does not require Timbl to keep statistics in memory (unlike the as, cm and cs verbosity options). Not available for the Compact and ARFF formats', paramflag='--evaluate'),
         ChoiceParameter('v', 'Verbosity Level', 'Verbosity level', multi=True, choices=[('o','Show all options set'),('b','Show node/branch count and branching factor'), ('f','Show calculated feature weights'), ('p','Show Value Difference matrices'), ('e', 'Show exact matches'), ('as', 'Show advances statistics (memory consuming)'), ('cm','Show confusion matrix (memory consuming)'),('cs','Show per class statistics (memory consuming)'),('cf','Add confidence to output file'),('di','Add distance to output file'),('db','Add distribution of best matches to output file'),('md','Add matching depth to output file'),('k','Add summary for all k neighbours'),('n','Add nearest neighbours to output file')], paramflag='-v', delimiter='+'),
     ]),
 ]
@@ -63,6 +63,18 @@ FLATURL = None
 SWITCHBOARD_FORWARD_URL = None
 FROG_FORWARD_URL = None
 
+#Tokenise in-process through the Python ucto bindings (python-ucto), initialising one tokeniser per language and
+#reusing it for all files in a job, rather than starting an ucto process for every file. Falls back to the ucto
+#executable if the bindings are not installed. Verbose output is always produced by the ucto executable.
+UCTO_INPROCESS = True
+
+#Output files are produced in parallel by a bounded pool of workers (0 = number of CPU cores)
+UCTO_MAXWORKERS = 4
+
+#Large documents are split into chunks of about this size (at paragraph boundaries), which are tokenised in parallel
+#and merged back (in order) into a single output file
+UCTO_CHUNKSIZE = 20 * 1024 * 1024 #in bytes (0 = never split documents)
+
 #Load externa configuration file
 loadconfig(__name__)
 
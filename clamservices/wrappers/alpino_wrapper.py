@@ -28,19 +28,217 @@ import re
 import string
 import glob
 import traceback
+import time
+import io
+import socket
+import zipfile
+import threading
 
 #import CLAM-specific modules. The CLAM API makes a lot of stuff easily accessible.
 import clam.common.data
 import clam.common.status
 
-from clamservices.config.alpino import CUSTOM_FORMATS
-from natsort import natsorted
+from clamservices.config.alpino import CUSTOM_FORMATS, ALPINO_FOLIA_CHECKPOINT_SENTENCES, ALPINO_FOLIA_CHECKPOINT_INTERVAL, ALPINO_PROCESSES, ALPINO_POOL_SIZE, ALPINO_POOL_HOST, ALPINO_POOL_PORT, ALPINO_POOL_DIR, ALPINO_POOL_STARTTIMEOUT, ALPINO_POOL_MAXRESTARTS, ALPINO_KEEP_XMLDIR, ALPINO_CACHE_FILE, ALPINO_CACHE_SIZE, ALPINO_SENTENCE_TIMEOUT, ALPINO_JOB_TIMEOUT
+from clamservices.wrappers.serverpool import ServerPool
+from clamservices.wrappers.resultcache import BlobCache
+from clamservices.wrappers.parallel import runparallel, call, abort
 
 from foliatools import alpino2folia
 
 #make a shortcut to the shellsafe() function
 shellsafe = clam.common.data.shellsafe
 
+class XMLCollection(object):
+    """Alpino XML Collection (a zip archive with an XML file per sentence), written as sentences are produced. If xmldir is set, the XML files are also written to that directory."""
+
+    def __init__(self, filename, xmldir=None):
+        self.archive = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.xmldir = xmldir
+        if self.xmldir and not os.path.isdir(self.xmldir):
+            os.mkdir(self.xmldir)
+        self.lock = threading.Lock()
+
+    def add(self, key, xml):
+        with self.lock:
+            self.archive.writestr(key + ".xml", xml)
+            if self.xmldir:
+                with open(os.path.join(self.xmldir, key + ".xml"),'wb') as f:
+                    f.write(xml)
+
+    def close(self):
+        self.archive.close()
+
+#Alpino command for parsing a file with one (keyed) sentence per line, writes the XML for every sentence to standard output
+ALPINO_PARSECMD = "/bin/Alpino -veryfast debug=1 end_hook=xml_dump user_max=" + str(int(ALPINO_SENTENCE_TIMEOUT * 1000)) + " -parse"
+#Alpino command to start a server on a given port, the server returns the XML for every sentence submitted to it
+ALPINO_SERVERCMD = "/bin/Alpino -notk -veryfast user_max=" + str(int(ALPINO_SENTENCE_TIMEOUT * 1000)) + " server_kind=parse server_port={port} assume_input_is_tokenized=on debug=0 end_hook=xml_dump -init_dict_p batch_command=alpino_server"
+
+#A line that already carries a key, in Alpino's key|sentence convention
+KEYEDLINE = re.compile(r'^([^\s|/]+)\|(.*)$')
+
+#End of the XML of a sentence, and its sentence ID (the key) in the output of Alpino
+XMLEND = b"</alpino_ds>"
+SENTID = re.compile(br'sentid="([^"]*)"')
+
+def readsentences(tokfile):
+    """Read a tokenised file with one sentence per line, returns a list of (key, sentence) tuples (blank lines are skipped).
+
+    Lines that already carry a key (key|sentence, as Alpino accepts them) keep that key, the key of other lines is their
+    sentence number. Keys are made unique, they name the output files."""
+    sentences = []
+    keys = set()
+    with io.open(tokfile,'r',encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            match = KEYEDLINE.match(line)
+            if match:
+                key, line = match.group(1), match.group(2).strip()
+            else:
+                key = str(len(sentences)+1)
+            if not line:
+                continue
+            while key in keys:
+                key += "." + str(len(sentences)+1)
+            keys.add(key)
+            sentences.append( (key, line) )
+    return sentences
+
+def parse_fork(sentences, processes, store, skip, deadline=None):
+    """Parse sentences by running Alpino processes, store(key, xml) is called for the output of every sentence and
+    skip(key, sentence, reason) for every sentence that could not be parsed in time (or before the deadline, a time in
+    seconds since the epoch). Returns True on success.
+
+    Alpino is single-threaded, so the sentences are distributed over multiple Alpino processes. Each sentence is
+    prefixed with its key (key|sentence, Alpino splits at the first |, so the sentence itself may contain |), Alpino
+    puts this key in the sentid of the output. The XML of every sentence is read from the standard output of the Alpino
+    processes and passed to store() as soon as it is complete, nothing is written to disk in between."""
+    processes = max(1, min(processes, len(sentences)))
+    shardfiles = [ ".alpino.shard" + str(i+1) + ".tok" for i in range(processes) ]
+    shards = [ io.open(shardfile,'w',encoding='utf-8') for shardfile in shardfiles ]
+    for i, (key, sentence) in enumerate(sentences):
+        shards[i % processes].write(key + "|" + sentence + "\n")
+    for shard in shards:
+        shard.close()
+    os.environ['ALPINO_HOME'] = ALPINO_HOME
+    print("Running " + str(processes) + " Alpino process(es)",file=sys.stderr)
+
+    stored = set() #keys of the sentences passed to store()
+    def parse(shardfile):
+        """Run Alpino on a shard and pass the output of every sentence to store(), returns the exit code of Alpino"""
+        pending = [b""] #output of the sentence Alpino is working on
+        def output(data):
+            pending[0] += data
+            while XMLEND in pending[0]:
+                end = pending[0].index(XMLEND) + len(XMLEND)
+                xml, pending[0] = pending[0][:end], pending[0][end:]
+                begin = xml.find(b"<?xml")
+                match = SENTID.search(xml)
+                if begin == -1 or match is None:
+                    print("Discarding unrecognised output of Alpino: " + xml[:200].decode('utf-8','replace'),file=sys.stderr)
+                    continue
+                key = match.group(1).decode('utf-8')
+                store(key, xml[begin:] + b"\n")
+                stored.add(key)
+        r = call(ALPINO_HOME + ALPINO_PARSECMD + " < " + shellsafe(shardfile,'"'), output)
+        if pending[0].strip():
+            #output of an Alpino process that was terminated at the job deadline, the sentence is reported as skipped
+            print("Discarding incomplete output of Alpino for " + shardfile,file=sys.stderr)
+        return r
+
+    #monitor the job time budget while Alpino is running, store() reports the progress
+    finished = threading.Event()
+    expired = threading.Event()
+    def monitor():
+        while not finished.wait(1):
+            if deadline and time.time() > deadline:
+                print("Job time budget exceeded, stopping Alpino",file=sys.stderr)
+                expired.set()
+                abort()
+                break
+    monitorthread = threading.Thread(target=monitor)
+    monitorthread.start()
+
+    success = True
+    for shardfile, r in runparallel(parse, shardfiles, processes):
+        if r != 0:
+            abort()
+            success = False
+            break
+    finished.set()
+    monitorthread.join()
+    if expired.is_set():
+        success = True #not an error, the sentences that were not parsed in time are reported
+    for shardfile in shardfiles:
+        os.unlink(shardfile)
+    if success:
+        for key, sentence in sentences:
+            if key not in stored:
+                skip(key, sentence, "job time budget exceeded" if expired.is_set() else "no parse within the sentence time budget")
+    return success
+
+def setsentid(xml, key):
+    """Set the sentence ID (the key) in Alpino XML output"""
+    return re.sub(br'sentid="[^"]*"', b'sentid="' + key.encode('utf-8') + b'"', xml, count=1)
+
+def cachekey(sentence):
+    """Key for the parse cache: the normalised token sequence and everything that influences the parse"""
+    return BlobCache.key(" ".join(sentence.split()), ALPINO_HOME, ALPINO_PARSECMD)
+
+def alpinoserver(port):
+    return [ x.replace('{port}', str(port)) for x in (ALPINO_HOME + ALPINO_SERVERCMD).split(" ") ]
+
+def submit(slot, sentence):
+    """Submit a sentence to an Alpino server and return the resulting XML"""
+    s = socket.create_connection((slot.host, slot.port))
+    s.settimeout(ALPINO_SENTENCE_TIMEOUT + 60) #grace period on top of Alpino's own time budget
+    try:
+        s.sendall(sentence.encode('utf-8') + b"\n")
+        s.shutdown(socket.SHUT_WR)
+        response = b""
+        while True:
+            data = s.recv(65536)
+            if not data:
+                break
+            response += data
+    finally:
+        s.close()
+    if not response.strip():
+        raise IOError("Alpino server returned no output")
+    return response
+
+def parse_server(pool, sentences, workers, store, skip, deadline=None):
+    """Parse sentences using the resident Alpino servers of the pool, store(key, xml) and skip(key, sentence, reason)
+    are called as by parse_fork(). Returns the sentences that could not be parsed this way."""
+    def parse(group):
+        with pool.acquire(ALPINO_SERVERCMD, alpinoserver) as slot:
+            if slot is None:
+                return group
+            for i, (key, sentence) in enumerate(group):
+                if deadline and time.time() > deadline:
+                    for key, sentence in group[i:]:
+                        skip(key, sentence, "job time budget exceeded")
+                    return []
+                try:
+                    xml = submit(slot, sentence)
+                except socket.timeout:
+                    #Alpino should have given up on its own (user_max), the server is stuck, restart it
+                    print("Alpino server timed out on sentence " + key, file=sys.stderr)
+                    skip(key, sentence, "sentence time budget exceeded")
+                    slot.fail()
+                    return group[i+1:]
+                except (IOError, socket.error) as e:
+                    print("Alpino server failed: " + str(e), file=sys.stderr)
+                    slot.fail()
+                    return group[i:]
+                #the server does not know our sentence key, set it
+                store(key, setsentid(xml, key))
+        return []
+    groups = [ sentences[i::workers] for i in range(workers) ]
+    remaining = set()
+    for _, unparsed in runparallel(parse, groups, workers):
+        remaining.update(key for key, _ in unparsed)
+    return [ (key, sentence) for key, sentence in sentences if key in remaining ]
+
 #this script takes three arguments from CLAM: $DATAFILE $STATUSFILE $OUTPUTDIRECTORY  (as configured at COMMAND= in the service configuration file)
 datafile = sys.argv[1]
 statusfile = sys.argv[2]
@@ -56,6 +254,15 @@ clamdata = clam.common.data.getclamdata(datafile, CUSTOM_FORMATS)
 
 clam.common.status.write(statusfile, "Starting...")
 
+#time at which the job time budget runs out, sentences not parsed by then are skipped
+deadline = time.time() + ALPINO_JOB_TIMEOUT if ALPINO_JOB_TIMEOUT else None
+
+#the persistent cache of sentence parses, shared with all other jobs of this service
+cache = BlobCache(ALPINO_CACHE_FILE, ALPINO_CACHE_SIZE)
+
+#the pool of resident Alpino servers, shared with all other jobs of this service
+pool = ServerPool(ALPINO_POOL_DIR, ALPINO_POOL_SIZE, ALPINO_POOL_HOST, ALPINO_POOL_PORT, ALPINO_POOL_STARTTIMEOUT, ALPINO_POOL_MAXRESTARTS)
+
 #SOME EXAMPLES (uncomment and adapt what you need)
 
 #-- Iterate over all input files? --
@@ -77,44 +284,106 @@ for inputfile in clamdata.input:
         tokfile = os.path.abspath(inputfilepath)
         os.system("sed -i 's/^M$//' " + shellsafe(tokfile,'"'))  #convert nasty DOS end-of-line to proper unix
 
-    clam.common.status.write(statusfile, "Running Alpino on " + basename)
-
     pwd = os.getcwd()
     os.chdir(outputdir)
-    if not os.path.exists("xml"):
-        os.mkdir("xml")
-    else:
-        for filename in glob.glob('xml/*.xml'):
-            os.unlink(filename) #clear for next round
 
-    cmd = "ALPINO_HOME=" + shellsafe(ALPINO_HOME) + " " + ALPINO_HOME + "/bin/Alpino -veryfast -flag treebank xml debug=1 end_hook=xml user_max=900000 -parse < "  + tokfile
-    print(cmd,file=sys.stderr)
-    r = os.system(cmd)
-    if r != 0:
+    #the XML output is written directly into the zip archive as sentences are produced, loose files are only kept if configured
+    collection = XMLCollection(basename + ".alpinoxml.zip", "xml_" + basename if ALPINO_KEEP_XMLDIR else None)
+
+    sentences = readsentences(tokfile)
+    total = len(sentences)
+    order = dict( (key, i) for i, (key, _) in enumerate(sentences) ) #key => position in the input, keys are not necessarily numbers
+
+    parsed = {} #keys of all sentences for which we have a parse
+    skipped = [] #(key, sentence, reason) tuples of all sentences that could not be parsed in time
+
+    #consult the parse cache first, only sentences we have not seen before are passed to the parser
+    if cache.enabled():
+        clam.common.status.write(statusfile, "Looking up " + basename + " in the parse cache")
+        for key, sentence in sentences:
+            xml = cache.get(cachekey(sentence))
+            if xml is not None:
+                collection.add(key, setsentid(xml, key))
+                parsed[key] = True
+        sentences = [ (key, sentence) for key, sentence in sentences if key not in parsed ]
+        clam.common.status.write(statusfile, "Parse cache for " + basename + ": " + str(total - len(sentences)) + " of " + str(total) + " sentences retrieved from cache")
+        print("Parse cache for " + basename + ": " + str(total - len(sentences)) + " of " + str(total) + " sentences retrieved from cache",file=sys.stderr)
+    sentencemap = dict(sentences)
+
+    def store(key, xml):
+        collection.add(key, xml)
+        parsed[key] = True
+        if key in sentencemap:
+            cache.put(cachekey(sentencemap[key]), xml)
+        reportprogress(len(parsed))
+
+    def skip(key, sentence, reason):
+        print("Skipping sentence " + key + ": " + reason,file=sys.stderr)
+        skipped.append( (key, sentence, reason) )
+
+    lastprogress = 0
+    def reportprogress(done):
+        global lastprogress
+        if time.time() - lastprogress >= 5:
+            clam.common.status.write(statusfile, "Parsed " + str(done) + " of " + str(total) + " sentences of " + basename, round(done / total * 100) if total else 0)
+            lastprogress = time.time()
+
+    if deadline and time.time() > deadline:
+        for key, sentence in sentences:
+            skip(key, sentence, "job time budget exceeded")
+        sentences = []
+
+    clam.common.status.write(statusfile, "Running Alpino on " + basename)
+    print("Parsing " + str(len(sentences)) + " sentences",file=sys.stderr)
+
+    #prefer the resident Alpino servers, fall back to starting Alpino ourselves for whatever they could not handle
+    if ALPINO_POOL_SIZE > 0 and sentences: #nothing to do (and no server to acquire) if everything came from the cache
+        sentences = parse_server(pool, sentences, min(max(ALPINO_PROCESSES,1), ALPINO_POOL_SIZE), store, skip, deadline)
+        if sentences:
+            print("Alpino server unavailable for " + str(len(sentences)) + " sentences, falling back to starting Alpino",file=sys.stderr)
+    if sentences and not parse_fork(sentences, ALPINO_PROCESSES, store, skip, deadline):
         print("Failure running alpino",file=sys.stderr)
         sys.exit(2)
+    collection.close()
+
+    if skipped:
+        #report the sentences that were skipped, they are absent from the XML collection and the FoLiA document
+        clam.common.status.write(statusfile, str(len(skipped)) + " of " + str(total) + " sentences of " + basename + " could not be parsed in time, see " + basename + ".timeouts.txt")
+        with io.open(os.path.join(outputdir, basename + ".timeouts.txt"),'w',encoding='utf-8') as f:
+            for key, sentence, reason in sorted(skipped, key=lambda x: order[x[0]]):
+                f.write(key + "\t" + reason + "\t" + sentence + "\n")
 
-    os.chdir("xml")
-    clam.common.status.write(statusfile, "Preparing output archive for " + basename)
-    os.system("zip ../" + basename + ".alpinoxml.zip *.xml")
     clam.common.status.write(statusfile, "Conversion to FoLiA for " + basename)
     foliafile = os.path.join(outputdir,basename +'.folia.xml')
     doc = alpino2folia.makefoliadoc(foliafile)
-    for filename in natsorted( os.path.basename(x) for x in glob.glob("*.xml") ):
-        try:
-            doc = alpino2folia.alpino2folia(filename,doc)
-            doc.save(foliafile)
-        except Exception as e: #pylint: disable=broad-except
-            print("Error converting Alpino to FoLiA (" + basename +"): " + str(e), file=sys.stderr)
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            formatted_lines = traceback.format_exc().splitlines()
-            traceback.print_tb(exc_traceback, limit=50, file=sys.stderr)
-
-    os.chdir('..')
-    os.rename('xml','xml_' + basename)
+    #the document is built in memory and serialised once at the end (or periodically according to the checkpoint policy),
+    #rather than after every sentence, which would make the conversion quadratic in the length of the document
+    converted = 0
+    lastcheckpoint = time.time()
+    with zipfile.ZipFile(basename + ".alpinoxml.zip", 'r') as archive:
+        for filename in sorted(archive.namelist(), key=lambda filename: order.get(filename[:-4], total)):
+            try:
+                doc = alpino2folia.alpino2folia(io.BytesIO(archive.read(filename)),doc)
+                converted += 1
+            except Exception as e: #pylint: disable=broad-except
+                print("Error converting Alpino to FoLiA (" + basename + ", " + filename + "): " + str(e), file=sys.stderr)
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                formatted_lines = traceback.format_exc().splitlines()
+                traceback.print_tb(exc_traceback, limit=50, file=sys.stderr)
+                continue
+            if (ALPINO_FOLIA_CHECKPOINT_SENTENCES and converted % ALPINO_FOLIA_CHECKPOINT_SENTENCES == 0) or (ALPINO_FOLIA_CHECKPOINT_INTERVAL and time.time() - lastcheckpoint >= ALPINO_FOLIA_CHECKPOINT_INTERVAL):
+                doc.save(foliafile)
+                lastcheckpoint = time.time()
+    doc.save(foliafile)
+
     os.chdir(pwd)
 
 
+cache.close()
+if cache.enabled():
+    print(cache.report(),file=sys.stderr)
+    clam.common.status.write(statusfile, "Parse " + cache.report())
+
 #A nice status message to indicate we're done
 clam.common.status.write(statusfile, "Done",100) # status update
 
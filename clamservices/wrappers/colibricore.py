@@ -17,15 +17,422 @@ from __future__ import print_function, unicode_literals, division, absolute_impo
 #import some general python modules:
 import sys
 import os
+import io
+import math
+import ctypes
+from contextlib import contextmanager
 
 #import CLAM-specific modules. The CLAM API makes a lot of stuff easily accessible.
 import clam.common.data
 import clam.common.status
 
+from clamservices.config.colibricore import COLIBRI_INPROCESS, COLIBRI_MAXWORKERS, COLIBRI_WORKERMEMORY, COLIBRI_MEMORY, COLIBRI_MEMORYPOLICY, COLIBRI_CACHE_SIZE, COLIBRI_CACHE_DIR
+from clamservices.wrappers.parallel import workercount, runparallel, call, abort
+from clamservices.wrappers.resultcache import ResultCache, hashfile
+
+try:
+    import colibricore
+except ImportError:
+    colibricore = None
+
 shellsafe = clam.common.data.shellsafe
 
+#the cache of previously built pattern models, shared with all other jobs of this service
+cache = ResultCache(COLIBRI_CACHE_DIR, COLIBRI_CACHE_SIZE)
+
+#Methods of the pattern models in the Python bindings that print an analysis output (to the standard output of the
+#process), and whether they take the class decoder as argument. The reverse index and co-occurrence outputs are not
+#wrapped by the bindings, they are computed by writereverseindex() and writecooc() instead.
+PRINTMETHODS = {
+    'extract': ('printmodel', True),
+    'report': ('report', False),
+    'histogram': ('printhistogram', False),
+}
+
+def requestedoutputs(settings):
+    """Returns a list of (output, extension, colibri-patternmodeller flags, threshold, needs corpus data) tuples for all requested analysis outputs"""
+    outputs = []
+    if settings['extract']:
+        outputs.append( ('extract', '.patterns.csv', '-P', None, False) )
+    if settings['report']:
+        outputs.append( ('report', '.report.txt', '-R', None, False) )
+    if settings['histogram']:
+        outputs.append( ('histogram', '.histogram.csv', '-H', None, False) )
+    if settings['reverseindex']:
+        outputs.append( ('reverseindex', '.reverseindex.csv', '-Z', None, True) )
+    if settings['cooc'] > 0:
+        outputs.append( ('cooc', '.cooc.csv', '-C ' + str(settings['cooc']), settings['cooc'], True) )
+    if settings['npmi'] > -1:
+        outputs.append( ('npmi', '.npmi.csv', '-Y ' + str(settings['npmi']), settings['npmi'], True) )
+    patterns = querypatterns(settings)
+    if patterns:
+        #(colibri-patternmodeller -q prints neither the unknown patterns nor the references, the fallback looks the patterns up in the full pattern list instead)
+        outputs.append( ('query', '.query.csv', '-P', None, False) )
+    return outputs
+
+def querypatterns(settings):
+    """Returns the list of patterns (strings) the user queried for, normalised like the corpus (lowercased if the corpus is)"""
+    if not settings['query']:
+        return []
+    patterns = [ " ".join(pattern.split()) for pattern in settings['query'].split(',') if pattern.strip() ]
+    if settings['lowercase']:
+        patterns = [ pattern.lower() for pattern in patterns ]
+    return patterns
+
+def writequery(outputfile, results, doindex):
+    """Write the query output: every queried pattern with its occurrence count (and, for indexed models, its positions in
+    the corpus as sentence:token). Results is a list of (pattern, count, references) tuples, references being (sentence, token) tuples"""
+    with io.open(outputfile,'w',encoding='utf-8') as f:
+        f.write("PATTERN\tCOUNT" + ("\tREFERENCES" if doindex else "") + "\n")
+        for text, count, references in results:
+            f.write(text + "\t" + str(count))
+            if doindex:
+                f.write("\t" + " ".join(str(sentence) + ":" + str(token) for sentence, token in sorted(references)))
+            f.write("\n")
+
+def querymodel(model, classfile, patterns, outputfile, doindex):
+    """Look up the given patterns directly in the model and write the query output"""
+    encoder = colibricore.ClassEncoder(classfile)
+    results = []
+    for text in patterns:
+        pattern = encoder.buildpattern(text, allowunknown=True)
+        if pattern in model:
+            results.append( (text, model.occurrencecount(pattern), list(model[pattern]) if doindex else []) )
+        else:
+            results.append( (text, 0, []) )
+    writequery(outputfile, results, doindex)
+
+def querypatternlist(patternlist, patterns, outputfile, doindex):
+    """Look up the given patterns in a full pattern list (as written by colibri-patternmodeller -P) and write the query output, used without the Python bindings"""
+    found = {}
+    wanted = set(patterns)
+    with io.open(patternlist,'r',encoding='utf-8',errors='replace') as f:
+        next(f, None) #header
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if fields[0] in wanted:
+                references = []
+                if doindex and len(fields) > 7:
+                    references = [ tuple(int(x) for x in reference.split(":")) for reference in fields[7].split() ]
+                found[fields[0]] = (int(fields[1]), references)
+    writequery(outputfile, [ (text,) + found.get(text, (0, [])) for text in patterns ], doindex)
+
+def writereverseindex(model, corpus, decoder, outputfile):
+    """Write the reverse index in the same format as colibri-patternmodeller -Z: every position in the corpus (sentence:token), followed by all patterns occurring there"""
+    with io.open(outputfile,'w',encoding='utf-8') as f:
+        currentsentence = None
+        positions = {}
+        for sentence, token in corpus:
+            if sentence != currentsentence:
+                currentsentence = sentence
+                positions = {}
+                for (_, position), pattern in model.getreverseindex_bysentence(sentence):
+                    positions.setdefault(position, []).append(pattern.tostring(decoder))
+            f.write(str(sentence) + ":" + str(token) + "".join("\t" + pattern for pattern in positions.get(token, ())) + "\n")
+        f.write("\n")
+
+def writecooc(model, decoder, threshold, outputfile, npmi=False):
+    """Compute the co-occurrences of all patterns in an indexed model, as joint occurrence counts or as normalised pointwise
+    mutual information (npmi=True), and write those passing the threshold in the same format as colibri-patternmodeller -C/-Y (sorted by value)"""
+    relations = []
+    if npmi:
+        total = model.totaloccurrencesingroup(0,0)
+        for pattern in model:
+            count = model.occurrencecount(pattern)
+            for pattern2, jointcount in model.getcooc(pattern):
+                try:
+                    #as computed by PatternModel::npmi() in colibri-core
+                    value = math.log(jointcount / (count * model.occurrencecount(pattern2))) / -math.log(jointcount / total)
+                except (ValueError, ZeroDivisionError):
+                    continue
+                if value >= threshold:
+                    relations.append( (value, pattern, pattern2) )
+    else:
+        for pattern in model:
+            for pattern2, jointcount in model.getcooc(pattern, int(threshold)):
+                if jointcount >= threshold:
+                    relations.append( (jointcount, pattern, pattern2) )
+    relations.sort(key=lambda relation: relation[0], reverse=True)
+    with io.open(outputfile,'w',encoding='utf-8') as f:
+        f.write("Pattern1\tPattern2\t" + ("NPMI" if npmi else "Cooc") + "\n")
+        for value, pattern, pattern2 in relations:
+            f.write(pattern.tostring(decoder) + "\t" + pattern2.tostring(decoder) + "\t" + ("%g" % value if npmi else str(value)) + "\n")
+
+@contextmanager
+def redirectstdout(filename):
+    """Redirect the standard output of the process (which the C++ library writes to) to a file"""
+    libc = ctypes.CDLL(None)
+    sys.stdout.flush()
+    libc.fflush(None)
+    saved = os.dup(1)
+    try:
+        with open(filename,'wb') as f:
+            os.dup2(f.fileno(), 1)
+            try:
+                yield
+            finally:
+                sys.stdout.flush()
+                libc.fflush(None)
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+
+def analyse_inprocess(prefix, outputs, settings, doindex):
+    """Load the pattern model (and the corpus data, if needed) once through the Python bindings and produce all outputs from it"""
+    modeloptions = colibricore.PatternModelOptions(mintokens=settings['mintokens'], minlength=settings['minlength'], maxlength=settings['maxlength'], doskipgrams=bool(settings['skipgrams']))
+    decoder = colibricore.ClassDecoder(prefix + '.colibri.cls')
+    corpus = None
+    if doindex or any(needscorpus for _, _, _, _, needscorpus in outputs):
+        corpus = colibricore.IndexedCorpus(prefix + '.colibri.dat')
+    if doindex:
+        model = colibricore.IndexedPatternModel(prefix + '.colibri.patternmodel', modeloptions, reverseindex=corpus)
+    else:
+        model = colibricore.UnindexedPatternModel(prefix + '.colibri.patternmodel', modeloptions, reverseindex=corpus)
+    for output, extension, _, threshold, _ in outputs:
+        if output == 'query':
+            querymodel(model, prefix + '.colibri.cls', querypatterns(settings), prefix + extension, doindex)
+        elif output == 'reverseindex':
+            writereverseindex(model, corpus, decoder, prefix + extension)
+        elif output in ('cooc','npmi'):
+            writecooc(model, decoder, threshold, prefix + extension, npmi=(output == 'npmi'))
+        else:
+            method, takesdecoder = PRINTMETHODS[output]
+            with redirectstdout(prefix + extension):
+                if takesdecoder:
+                    getattr(model, method)(decoder)
+                else:
+                    getattr(model, method)()
+
+def analyse(bindir, prefix, outputs, settings, options, doindex):
+    """Produce all requested analysis outputs for a built pattern model, returns True on success"""
+    if COLIBRI_INPROCESS and colibricore is not None:
+        try:
+            analyse_inprocess(prefix, outputs, settings, doindex)
+            return True
+        except Exception as e: #pylint: disable=broad-except
+            print("Unable to analyse the pattern model through the Python bindings (" + str(e) + "), falling back to colibri-patternmodeller",file=sys.stderr)
+    elif COLIBRI_INPROCESS:
+        print("Python colibricore bindings not available, falling back to colibri-patternmodeller",file=sys.stderr)
+
+    #without the bindings, every output requires colibri-patternmodeller to load the model again
+    cmd = bindir + 'colibri-patternmodeller ' + options + ' -i ' + shellsafe(prefix + '.colibri.patternmodel',"'") + " -c " + shellsafe(prefix + ".colibri.cls","'")
+    success = True
+    for output, extension, flags, _, needscorpus in outputs:
+        if needscorpus or settings['skipgrams']:
+            #(-r was an alias for -f before colibri-core 2.4.4, and is the simple report now)
+            flags = "-f " + shellsafe(prefix + ".colibri.dat","'") + " " + flags
+        if output == 'query':
+            if call(cmd + " " + flags + " > " + shellsafe(prefix + '.query.patterns.csv',"'")) != 0:
+                success = False
+            else:
+                querypatternlist(prefix + '.query.patterns.csv', querypatterns(settings), prefix + extension, doindex)
+            os.unlink(prefix + '.query.patterns.csv')
+        elif call(cmd + " " + flags + " > " + shellsafe(prefix + extension,"'")) != 0:
+            success = False
+    return success
+
+
+#Parameters the pipelines depend on, passed to the worker processes
+SETTINGS = ('lowercase','mintokens','minlength','maxlength','skipgrams','indexing','extract','report','histogram','reverseindex','cooc','npmi')
+
+def lowercasefile(source, target):
+    """Write a lowercased copy of a text file (bytes that are not valid UTF-8 are passed through unchanged)"""
+    with io.open(source,'r',encoding='utf-8',errors='surrogateescape') as fin:
+        with io.open(target,'w',encoding='utf-8',errors='surrogateescape') as fout:
+            for line in fin:
+                fout.write(line.lower())
+
+def prepare(bindir, outputdir, inputfile, lowercase=False):
+    """Make a (tokenised, and lowercased if requested) input file available in the output directory, returns its path or None on failure"""
+    filename, inputtemplate, metadata = inputfile
+    if inputtemplate == 'textinput_tok':
+        target = outputdir + '/' + filename + '.txt'
+        if lowercase:
+            lowercasefile(metadata['path'], target)
+        else:
+            os.symlink(os.path.abspath(metadata['path']), target)
+    elif inputtemplate == 'textinput_untok':
+        #we'll need to tokenise first
+        target = outputdir + '/' + filename + '.txt'
+        uctooptions = '-l ' if lowercase else ''
+        if metadata['sentenceperline_input']:
+            uctooptions += "-m "
+        if metadata['sentenceperline_output']:
+            uctooptions += "-n "
+        if call(bindir + 'ucto -L ' + shellsafe(metadata['language'],"'")+ ' ' + uctooptions + ' ' + shellsafe(metadata['path'],'"') + ' > ' + shellsafe(target,"'")) != 0:
+            return None
+    else:
+        if lowercase:
+            print("Lowercasing is not supported for FoLiA input, " + filename + " is encoded as is",file=sys.stderr)
+        target = outputdir + '/' + filename + '.xml'
+        os.symlink(os.path.abspath(metadata['path']), target)
+    return target
+
+def requiresindex(settings):
+    """Returns whether the requested outputs can only be produced from an indexed model"""
+    return settings['cooc'] > 0 or settings['npmi'] > -1
+
+def buildoptions(settings):
+    """Returns whether the model is indexed and the colibri-patternmodeller options to build it with"""
+    doindex = bool(settings['indexing']) or requiresindex(settings)
+    options = ""
+    if not doindex:
+        options += "-u "
+    if settings['skipgrams']:
+        options += "-s "
+    options += "-t " + str(settings['mintokens']) + " "
+    options += "-m " + str(settings['minlength']) + " "
+    options += "-l " + str(settings['maxlength']) + " "
+    return doindex, options
+
+#Parameters of the memory estimate. It is an upper bound rather than a prediction, as it assumes every distinct pattern
+#occurs exactly mintokens times. Measured against colibri-patternmodeller (colibri-core 2.5.9) on 2.3M tokens of English
+#text, it was 1.1 to 1.7 times the actual peak memory usage for high thresholds or short patterns, and up to 6 times
+#for threshold 2 with longer patterns or skipgrams (the actual usage hardly grows with the maximum length). On synthetic
+#text with very many distinct bigrams and a high threshold, it underestimated the peak usage by about 30%.
+BYTESPERTOKEN = 2 #average size of a token in the encoded corpus data (including sentence boundaries), measured was about 1.4
+PATTERNBYTES = 48 #size of a pattern model entry, excluding the pattern itself
+REFERENCEBYTES = 8 #size of a single occurrence (sentence, token) in an indexed model
+TRAININGFACTOR = 1.5 #overhead of candidate patterns held during training, before they are pruned
+MAXTHRESHOLD = 1024 #the occurrence threshold is not raised beyond this when degrading
+
+def estimatememory(datsize, settings, doindex):
+    """Roughly estimate the peak memory usage (in MB) of building a pattern model on encoded corpus data of the given size (in bytes)"""
+    tokens = datsize / BYTESPERTOKEN
+    total = 0
+    #shorter patterns are counted during training even if they are below the minimum length
+    for n in range(1, max(1, settings['maxlength']) + 1):
+        #the number of possible gap configurations for skipgrams of this length
+        configurations = 1
+        if settings['skipgrams'] and n >= 3:
+            configurations += 2 ** (n - 2) - 1
+        #every position in the corpus starts at most one pattern per configuration, and a distinct pattern occurs at least mintokens times
+        occurrences = tokens * configurations
+        patterns = occurrences / max(1, settings['mintokens'])
+        total += patterns * (PATTERNBYTES + n * BYTESPERTOKEN)
+        if doindex:
+            total += occurrences * REFERENCEBYTES
+    total *= TRAININGFACTOR
+    if doindex:
+        total += datsize #the corpus data is loaded as well
+    return total / (1024 * 1024)
+
+def fitmemory(datsize, settings, budget, name):
+    """Check the estimated memory usage of building the pattern model against the memory budget (in MB). Depending on
+    COLIBRI_MEMORYPOLICY, the settings are degraded (in-place) until the model fits. Returns an error message if the
+    model does not fit (None otherwise), and a list of descriptions of the degradations that were applied."""
+    doindex = buildoptions(settings)[0]
+    estimate = estimatememory(datsize, settings, doindex)
+    degradations = []
+    if estimate <= budget:
+        return None, degradations
+    message = "Building the pattern model for " + name + " would require an estimated " + str(int(estimate)) + " MB of memory, which exceeds the available " + str(budget) + " MB"
+    if COLIBRI_MEMORYPOLICY != 'degrade':
+        return message + ". Please raise the occurrence threshold, lower the maximum length, or disable skipgrams or indexing.", degradations
+    print(message + ", degrading the model",file=sys.stderr)
+    if doindex and not requiresindex(settings):
+        settings['indexing'] = False
+        doindex = False
+        estimate = estimatememory(datsize, settings, doindex)
+        degradations.append("indexing disabled")
+        print("Indexing disabled for " + name + ", estimated memory usage is now " + str(int(estimate)) + " MB",file=sys.stderr)
+    mintokens = settings['mintokens']
+    while estimate > budget and settings['mintokens'] * 2 <= MAXTHRESHOLD:
+        settings['mintokens'] = max(2, settings['mintokens'] * 2)
+        estimate = estimatememory(datsize, settings, doindex)
+        print("Occurrence threshold for " + name + " raised to " + str(settings['mintokens']) + ", estimated memory usage is now " + str(int(estimate)) + " MB",file=sys.stderr)
+    if settings['mintokens'] != mintokens:
+        degradations.append("occurrence threshold raised from " + str(mintokens) + " to " + str(settings['mintokens']))
+    if estimate > budget:
+        return message + ", even after degrading the model. Please lower the maximum length, or disable skipgrams or indexing.", degradations
+    return None, degradations
+
+def degradationnote(name, degradations):
+    """Returns a description of how the pattern model was degraded, for the status and the report"""
+    return "The pattern model for " + name + " was degraded to fit the memory budget: " + ", ".join(degradations)
+
+def encodingfiles(prefix):
+    """Returns the files of a class encoding (class file and encoded corpus data), for storing in/retrieving from the cache"""
+    return dict( (extension, prefix + '.' + extension) for extension in ('colibri.cls','colibri.dat') )
+
+def encode(bindir, outputdir, name, inputfiles, settings):
+    """Tokenise (if needed) and class encode one or more input files, returns an error message or None on success"""
+    corpusfiles = []
+    for inputfile in inputfiles:
+        corpusfile = prepare(bindir, outputdir, inputfile, settings['lowercase'])
+        if corpusfile is None:
+            return "Failure in tokenising " + inputfile[0]
+        corpusfiles.append(corpusfile)
+    if len(inputfiles) > 1:
+        #one shared class encoding and one unified corpus for all input files
+        r = call(bindir + 'colibri-classencode -u -o ' + shellsafe(outputdir + '/' + name,"'") + ' ' + ' '.join(shellsafe(corpusfile,"'") for corpusfile in corpusfiles))
+    else:
+        r = call(bindir + 'colibri-classencode ' + shellsafe(corpusfiles[0],"'"))
+        if r == 0:
+            #files will be in the wrong place after classencode, move:
+            os.rename(name+'.colibri.cls', outputdir+'/'+name+'.colibri.cls')
+            os.rename(name+'.colibri.dat', outputdir+'/'+name+'.colibri.dat')
+    if r != 0:
+        return "Failure in class encoding " + name
+    return None
+
+def pipeline(task):
+    """Encode, model and analyse one or more input files. Returns an error message (None on success) and the list of
+    degradations applied to the model. Runs in a worker (thread or process)."""
+    bindir, outputdir, name, inputfiles, settings, budget = task
+    prefix = outputdir + '/' + name
+    settings = dict(settings) #degraded per model
+
+    #Class encoding
+    encodingkey = None
+    if cache.enabled():
+        #the class encoding only depends on the input data (and how it is tokenised)
+        encodingkey = cache.key("encoding", [ (hashfile(metadata['path']), inputtemplate, [ (key, value) for key, value in sorted(metadata.items()) if key != 'path' ]) for _, inputtemplate, metadata in inputfiles ],
+                                bool(settings['lowercase']))
+    if encodingkey and cache.get(encodingkey, encodingfiles(prefix)):
+        print("Class encoding for " + name + " retrieved from cache",file=sys.stderr)
+    else:
+        error = encode(bindir, outputdir, name, inputfiles, settings)
+        if error is not None:
+            return error, []
+        if encodingkey:
+            cache.put(encodingkey, encodingfiles(prefix))
+
+    #Pattern model
+    error, degradations = fitmemory(os.path.getsize(prefix + '.colibri.dat'), settings, budget, name)
+    if error is not None:
+        return error, degradations
+    doindex, options = buildoptions(settings)
+    modelkey = None
+    if encodingkey:
+        #the model is keyed on the settings it is actually built with (after fitmemory), not on the memory budget, which
+        #depends on the memory that happened to be available when the job started
+        modelkey = cache.key("model", encodingkey, settings['mintokens'], settings['minlength'], settings['maxlength'], bool(settings['skipgrams']), doindex)
+        if cache.get(modelkey, {'colibri.patternmodel': prefix + '.colibri.patternmodel'}):
+            print("Pattern model for " + name + " retrieved from cache, skipping straight to the analysis",file=sys.stderr)
+            return analysemodel(bindir, prefix, name, settings, degradations), degradations
+    r = call(bindir + 'colibri-patternmodeller ' + options + ' -f ' + shellsafe(prefix + '.colibri.dat',"'") + " -c " + shellsafe(prefix + ".colibri.cls","'") + " -o " + shellsafe(prefix + ".colibri.patternmodel","'") )
+    if r != 0:
+        return "Failure in building patternmodel for " + name, degradations
+    if modelkey:
+        cache.put(modelkey, {'colibri.patternmodel': prefix + '.colibri.patternmodel'})
+
+    return analysemodel(bindir, prefix, name, settings, degradations), degradations
+
+def analysemodel(bindir, prefix, name, settings, degradations):
+    """Produce all requested analysis outputs for a built pattern model, returns an error message or None on success"""
+    doindex, options = buildoptions(settings)
+    outputs = requestedoutputs(settings)
+    if outputs and not analyse(bindir, prefix, outputs, settings, options, doindex):
+        return "Error processing " + name
+    if degradations and settings['report']:
+        #the report states the settings the model was actually built with
+        with io.open(prefix + '.report.txt','r',encoding='utf-8',errors='replace') as f:
+            report = f.read()
+        with io.open(prefix + '.report.txt','w',encoding='utf-8') as f:
+            f.write("NOTE: " + degradationnote(name, degradations) + "\n\n" + report)
+    return None
 
-#curdir = os.getcwd()
 
 if __name__ == "__main__":
 
@@ -43,94 +450,48 @@ if __name__ == "__main__":
 
     clam.common.status.write(statusfile, "Starting...")
 
+    settings = dict( (key, clamdata[key]) for key in SETTINGS )
+    settings['query'] = clamdata['query'] if 'query' in clamdata else None
 
-
-
-    for i, inputfile in enumerate(clamdata.input):
-        #Update our status message to let CLAM know what we're doing
-        p = round((i/float(len(clamdata.input)))*100)
-
-
+    inputfiles = []
+    for inputfile in clamdata.input:
         filename = os.path.basename(str(inputfile))
         #strip extension
         filename = filename[:-4]
-
         inputtemplate = inputfile.metadata.inputtemplate
-
-
-        if inputtemplate == 'textinput_tok':
-            os.symlink(os.path.abspath(str(inputfile)),outputdir + '/' + filename + '.txt')
-        elif inputtemplate == 'textinput_untok':
-            #we'll need to tokenise first
-            language = inputfile.metadata['language']
-            clam.common.status.write(statusfile, "Tokenising " + filename + "...", p)
-            uctooptions = ''
-            if inputfile.metadata['sentenceperline_input']:
-                uctooptions += "-m "
-            if inputfile.metadata['sentenceperline_output']:
-                uctooptions += "-n "
-            os.system(bindir + 'ucto -L ' + shellsafe(language,"'")+ ' ' + uctooptions + ' ' + shellsafe(str(inputfile),'"') + ' > ' + shellsafe(outputdir +'/'+ filename + '.txt',"'"))
-
-        elif inputtemplate == 'foliainput':
-            os.symlink(os.path.abspath(str(inputfile)),outputdir + '/' + filename + '.xml')
-
-
-
-        clam.common.status.write(statusfile, "Class Encoding " + filename + "...", p)
-        if inputtemplate == 'foliainput':
-            os.system(bindir + 'colibri-classencode ' +  outputdir+'/'+filename +'.xml')
-        else:
-            os.system(bindir + 'colibri-classencode ' + outputdir+'/'+filename +'.txt')
-
-        #files will be in the wrong place after classencode, move:
-        os.rename(filename+'.colibri.cls', outputdir+'/'+filename+'.colibri.cls')
-        os.rename(filename+'.colibri.dat', outputdir+'/'+filename+'.colibri.dat')
-
-        doindex = clamdata['indexing'] or clamdata['cooc'] or clamdata['npmi']
-
-        options = ""
-        if not doindex:
-            options += "-u "
-        if clamdata['skipgrams']:
-            options += "-s "
-        options += "-t " + str(clamdata['mintokens']) + " "
-        options += "-m " + str(clamdata['minlength']) + " "
-        options += "-l " + str(clamdata['maxlength']) + " "
-
-        clam.common.status.write(statusfile, "Building pattern model for " + filename + "...", p)
-        r = os.system(bindir + 'colibri-patternmodeller ' + options + ' -f ' + shellsafe(outputdir + '/' + filename + '.colibri.dat',"'") + " -c " + shellsafe(outputdir + '/' + filename + ".colibri.cls","'") + " -o " + shellsafe(outputdir + '/' + filename + ".colibri.patternmodel","'") )
-        if r != 0:
-            clam.common.status.write(statusfile, "Failure in building patternmodel for " + filename,100) # status update
+        metadata = { 'path': str(inputfile) }
+        if inputtemplate == 'textinput_untok':
+            for key in ('language','sentenceperline_input','sentenceperline_output'):
+                metadata[key] = inputfile.metadata[key]
+        inputfiles.append( (filename, inputtemplate, metadata) )
+
+    if 'combine' in clamdata and clamdata['combine'] and len(inputfiles) > 1:
+        #one pattern model over all input files together
+        models = [ ('corpus', inputfiles) ]
+    else:
+        models = [ (inputfile[0], [inputfile]) for inputfile in inputfiles ]
+
+    #Pattern models (especially indexed ones) are memory intensive, so the number of parallel pipelines is bounded by
+    #the memory budget, which is shared equally between the workers
+    workers = min(workercount(COLIBRI_MAXWORKERS, COLIBRI_WORKERMEMORY, len(models)), max(1, COLIBRI_MEMORY // COLIBRI_WORKERMEMORY))
+    budget = COLIBRI_MEMORY // workers
+    tasks = [ (bindir, outputdir, name, modelinputfiles, settings, budget) for name, modelinputfiles in models ]
+    print("Processing " + str(len(tasks)) + " pattern model(s) using " + str(workers) + " worker(s)",file=sys.stderr)
+    clam.common.status.write(statusfile, "Building " + str(len(tasks)) + " pattern model(s)...", 0)
+
+    #In-process analysis redirects the standard output of the process, so it needs worker processes, otherwise threads
+    #suffice as the actual work is done by the colibri tools. Either way, abort() terminates all pipelines that are still running.
+    done = 0
+    for task, (error, degradations) in runparallel(pipeline, tasks, workers, processes=COLIBRI_INPROCESS and colibricore is not None):
+        if error is not None:
+            abort()
+            clam.common.status.write(statusfile, error,100) # status update
             sys.exit(1)
-
-
-
-        cmd = bindir + 'colibri-patternmodeller ' + options + ' -i ' + shellsafe(outputdir + '/' + filename + '.colibri.patternmodel',"'") + " -c " + shellsafe(outputdir + '/' + filename + ".colibri.cls","'")
-
-        if clamdata['extract']:
-            clam.common.status.write(statusfile, "Outputting pattern list for " + filename + "...", p)
-            r = os.system(cmd + " -P > " + outputdir + '/' + filename + ".patterns.csv")
-        if clamdata['report']:
-            clam.common.status.write(statusfile, "Computing and outputting report for " +  filename + "...", p)
-            r = os.system(cmd + " -R > " + outputdir + '/' + filename + ".report.txt")
-        if clamdata['histogram']:
-            clam.common.status.write(statusfile, "Computing and outputting histogram for " + filename + "...", p)
-            r = os.system(cmd + " -H > " + outputdir + '/' + filename + ".histogram.csv")
-        if clamdata['reverseindex']:
-            clam.common.status.write(statusfile, "Computing and outputting reverse index for " + filename + "...", p)
-            r = os.system(cmd + " -r " + outputdir + '/' + filename + ".colibri.dat" + " -Z > " + filename + ".reverseindex.csv")
-        if clamdata['cooc'] > 0:
-            clam.common.status.write(statusfile, "Computing and outputting co-occurrences for " + filename + "...", p)
-            r = os.system(cmd + " -r " + outputdir + '/' + filename + ".colibri.dat" + " -C " + str(clamdata['cooc']) + " > " + outputdir + '/' + filename + ".cooc.csv")
-        print("NPMI=",clamdata['npmi'], type(clamdata['npmi']),file=sys.stderr)
-        if clamdata['npmi'] > -1:
-            clam.common.status.write(statusfile, "Computing and outputting co-occurrences (npmi) for " + filename + "...", p)
-            r = os.system(cmd + " -r " + outputdir + '/' + filename + ".colibri.dat" + " -Y " + str(clamdata['npmi']) + " > " + outputdir + '/' + filename + ".npmi.csv")
-
-        if r != 0:
-            clam.common.status.write(statusfile, "Error processing " + filename,100) # status update
-            sys.exit(1)
-
+        if degradations:
+            clam.common.status.write(statusfile, degradationnote(task[2], degradations), round((done/len(tasks))*100))
+        done += 1
+        #Update our status message to let CLAM know what we're doing
+        clam.common.status.write(statusfile, "Processed " + task[2] + " (" + str(done) + " of " + str(len(tasks)) + ")", round((done/len(tasks))*100))
 
     #A nice status message to indicate we're done
     clam.common.status.write(statusfile, "Done",100) # status update
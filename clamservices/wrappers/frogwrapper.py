@@ -21,6 +21,11 @@ from __future__ import print_function, unicode_literals, division, absolute_impo
 #general python modules:
 import sys
 import os
+import io
+import re
+import socket
+import shutil
+import subprocess
 
 
 #import CLAM-specific modules:
@@ -29,8 +34,117 @@ import clam.common.status
 import clam.common.parameters
 import clam.common.formats
 
+from clamservices.config.frog import FROG_POOL_SIZE, FROG_POOL_HOST, FROG_POOL_PORT, FROG_POOL_DIR, FROG_POOL_STARTTIMEOUT, FROG_POOL_MAXRESTARTS, FROG_POOL_TIMEOUT, FROG_MAXWORKERS, FROG_WORKERMEMORY, FROG_SHARDSIZE, FROG_CACHE_DIR, FROG_CACHE_SIZE
+from clamservices.wrappers.serverpool import ServerPool
+from clamservices.wrappers.parallel import workercount, cpucount, runparallel, call, abort
+from clamservices.wrappers.sharding import splittext, mergefolia, concatenate
+from clamservices.wrappers.resultcache import ResultCache, hashfile
+
 shellsafe = clam.common.data.shellsafe
 
+#Document ID the pool servers are started with, replaced by the actual document ID in the output
+POOL_DOCID = "frogpooldoc"
+
+def frogserver(frogoptions):
+    """Returns a function producing the command to start a Frog server (with FoLiA output) on a given port"""
+    return lambda port: [os.path.join(bindir, "frog"), "--language=nld"] + frogoptions + ["-S", str(port), "-X", "--id=" + POOL_DOCID, "--threads=1"]
+
+def submit(slot, data):
+    """Submit a document to a Frog server and return the (FoLiA XML) result"""
+    s = socket.create_connection((slot.host, slot.port), FROG_POOL_TIMEOUT) #a hung server should not block the job (and the slot) forever
+    try:
+        s.sendall(data.rstrip(b"\n") + b"\nEOT\n")
+        response = b""
+        while not response.rstrip().endswith(b"READY"):
+            data = s.recv(65536)
+            if not data:
+                raise IOError("Frog server closed the connection prematurely")
+            response += data
+    finally:
+        s.close()
+    return response.rstrip()[:-len(b"READY")]
+
+def spanlabels(sentence, spantype):
+    """Map word IDs to IOB labels for all spans of the given type in a sentence"""
+    labels = {}
+    for span in sentence.select(spantype):
+        for i, word in enumerate(span.wrefs()):
+            labels[word.id] = ("B-" if i == 0 else "I-") + span.cls.upper()
+    return labels
+
+def writecolumns(doc, outputfile):
+    """Write Frog's columned output for a frogged FoLiA document (the pool servers only return FoLiA)"""
+    import folia.main as folia
+    with io.open(outputfile, 'w', encoding='utf-8') as f:
+        for sentence in doc.sentences():
+            words = list(sentence.words())
+            index = dict( (word.id, i+1) for i, word in enumerate(words) )
+            entities = spanlabels(sentence, folia.Entity)
+            chunks = spanlabels(sentence, folia.Chunk)
+            dependencies = {}
+            for dependency in sentence.select(folia.Dependency):
+                head = dependency.head().wrefs()
+                for dependent in dependency.dependent().wrefs():
+                    dependencies[dependent.id] = (index.get(head[0].id,0) if head else 0, dependency.cls)
+            for word in words:
+                try:
+                    pos = word.annotation(folia.PosAnnotation)
+                    posclass, confidence = pos.cls, ("%g" % pos.confidence if pos.confidence is not None else "")
+                except folia.NoSuchAnnotation:
+                    posclass, confidence = "", ""
+                try:
+                    lemma = word.lemma()
+                except folia.NoSuchAnnotation:
+                    lemma = ""
+                morph = "".join("[" + morpheme.text() + "]" for morpheme in word.morphemes())
+                head, deprel = dependencies.get(word.id, (0, "ROOT") if dependencies else ("", ""))
+                f.write("\t".join((str(index[word.id]), word.text(), lemma, morph, posclass, confidence, entities.get(word.id,"O"), chunks.get(word.id,"O"), str(head), deprel)) + "\n")
+            f.write("\n")
+
+def runfrog_pool(pool, inputfile, xmlinput, frogoptions, docid, outputprefix):
+    """Process a file using a resident Frog server, returns None if no server is available"""
+    import folia.main as folia
+    with pool.acquire(" ".join(frogoptions), frogserver(frogoptions)) as slot:
+        if slot is None:
+            return None
+        print("\tSubmitting to Frog server " + str(slot.index) + " (port " + str(slot.port) + ")",file=sys.stderr)
+        with open(str(inputfile),'rb') as f:
+            data = f.read()
+        try:
+            result = submit(slot, data).decode('utf-8')
+        except socket.timeout:
+            print("\tFrog server timed out on " + os.path.basename(str(inputfile)), file=sys.stderr)
+            slot.fail()
+            return None
+        except (IOError, socket.error) as e:
+            print("\tFrog server failed: " + str(e), file=sys.stderr)
+            slot.fail()
+            return None
+        if not xmlinput:
+            result = re.sub(r'((?:xml:)?id=")' + POOL_DOCID + r'(?=[."])', lambda m: m.group(1) + docid, result)
+        try:
+            doc = folia.Document(string=result)
+        except Exception as e: #pylint: disable=broad-except
+            #truncated or malformed output, the server is not to be trusted
+            print("\tFrog server returned invalid FoLiA: " + str(e), file=sys.stderr)
+            slot.fail()
+            return None
+    with io.open(outputprefix + ".xml",'w',encoding='utf-8') as f:
+        f.write(result)
+    writecolumns(doc, outputprefix + ".frog.out")
+    return True
+
+def frogversion():
+    """Returns the version of Frog (and its modules), used in the cache key"""
+    try:
+        return subprocess.check_output([os.path.join(bindir, "frog"), "--version"], stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def outputfiles(outputprefix):
+    """Returns the output files of a document, for storing in/retrieving from the cache"""
+    return { 'xml': outputprefix + ".xml", 'frog.out': outputprefix + ".frog.out" }
+
 #this script takes three arguments: $DATAFILE $STATUSFILE $OUTPUTDIRECTORY
 bindir = sys.argv[1]
 datafile = sys.argv[2]
@@ -48,58 +162,138 @@ clamdata = clam.common.data.getclamdata(datafile)
 
 clam.common.status.write(statusfile, "Starting...")
 
+#the pool of resident Frog servers, shared with all other jobs of this service
+pool = ServerPool(FROG_POOL_DIR, FROG_POOL_SIZE, FROG_POOL_HOST, FROG_POOL_PORT, FROG_POOL_STARTTIMEOUT, FROG_POOL_MAXRESTARTS)
+
+#the cache of previously computed results, shared with all other jobs of this service
+cache = ResultCache(FROG_CACHE_DIR, FROG_CACHE_SIZE)
+version = frogversion() if cache.enabled() else None
+if version is None:
+    cache.maxsize = 0 #without a version we can't guarantee the cached results are still valid
+
 #assemble parameters for Frog:
 
+tasks = []
+shards = {} #outputstem => sharding information for documents that are split into shards
 
 for i, inputfile in enumerate(clamdata.inputfiles('maininput')):
     cmdoptions = " --max-parser-tokens=200"
+    frogoptions = ["--max-parser-tokens=200"]
 
     if 'skip' in clamdata and clamdata['skip']:
         print("Skip options: ", "".join(clamdata['skip']),file=sys.stderr)
         cmdoptions += ' --skip=' + "".join(clamdata['skip'])
+        frogoptions.append('--skip=' + "".join(clamdata['skip']))
 
-
-    clam.common.status.write(statusfile, "Processing " + os.path.basename(str(inputfile)) + "...")
-
-    print("Processing " + os.path.basename(str(inputfile)) + "...", file=sys.stderr)
     outputstem = os.path.basename(str(inputfile))
     if outputstem[-4:] == '.xml' or outputstem[-4:] == '.txt': outputstem = outputstem[:-4]
     if 'sentenceperline' in inputfile.metadata and inputfile.metadata['sentenceperline']:
         cmdoptions += ' -n'
+        frogoptions.append('-n')
     if 'docid' in inputfile.metadata and inputfile.metadata['docid']:
         docid = inputfile.metadata['docid']
-        print("\tDocID from metadata: " + docid,file=sys.stderr)
+        print("DocID for " + os.path.basename(str(inputfile)) + " from metadata: " + docid,file=sys.stderr)
     else:
         docid = outputstem
-        print("\tDocID from filename: " + docid, file=sys.stderr)
+        print("DocID for " + os.path.basename(str(inputfile)) + " from filename: " + docid, file=sys.stderr)
     docid = docid.replace(' ','-')
     docid = docid.replace("'",'')
     docid = docid.replace('"','')
     if not docid:
         docid = 'untitled'
 
-    print("Invoking Frog",file=sys.stderr)
-    r = os.system(os.path.join(bindir, "frog") + " --language=nld " + shellsafe(cmdoptions) + " -t " + shellsafe(str(inputfile),'"') + " --id=" + shellsafe(docid,"'") + " -X " + shellsafe(outputdir + outputstem + ".xml","'") + " -o " + shellsafe(outputdir + outputstem + ".frog.out","'") + " --threads=1")
-    if r != 0:
-        clam.common.status.write(statusfile, "Frog returned with an error whilst processing " + os.path.basename(str(inputfile) + " (plain text). Aborting"),100)
-        sys.exit(1)
+    cachekey = None
+    if cache.enabled():
+        cachekey = cache.key("text", hashfile(str(inputfile)), "".join(clamdata['skip']) if 'skip' in clamdata and clamdata['skip'] else "", bool('sentenceperline' in inputfile.metadata and inputfile.metadata['sentenceperline']), docid, version)
+        if cache.get(cachekey, outputfiles(outputdir + outputstem)):
+            print("Results for " + os.path.basename(str(inputfile)) + " retrieved from cache",file=sys.stderr)
+            continue
+
+    if FROG_SHARDSIZE > 0 and os.path.getsize(str(inputfile)) > FROG_SHARDSIZE:
+        #large document: split at paragraph/sentence boundaries into shards that are frogged in parallel and merged afterwards
+        shardsdir = outputdir + "." + outputstem + ".shards"
+        if not os.path.isdir(shardsdir):
+            os.mkdir(shardsdir)
+        shardfiles = splittext(str(inputfile), FROG_SHARDSIZE, os.path.join(shardsdir, outputstem), 'sentenceperline' in inputfile.metadata and inputfile.metadata['sentenceperline'])
+        print("Split " + os.path.basename(str(inputfile)) + " into " + str(len(shardfiles)) + " shards",file=sys.stderr)
+        shards[outputstem] = { 'dir': shardsdir, 'outputprefixes': [ shardfile[:-4] for shardfile in shardfiles ], 'remaining': len(shardfiles), 'docid': docid, 'cachekey': cachekey }
+        for shardfile in shardfiles:
+            tasks.append( {'inputfile': shardfile, 'xmlinput': False, 'cmdoptions': cmdoptions, 'frogoptions': frogoptions, 'docid': docid, 'outputprefix': shardfile[:-4], 'outputstem': outputstem, 'cachekey': None} )
+    else:
+        tasks.append( {'inputfile': str(inputfile), 'xmlinput': False, 'cmdoptions': cmdoptions, 'frogoptions': frogoptions, 'docid': docid, 'outputprefix': outputdir + outputstem, 'outputstem': outputstem, 'cachekey': cachekey} )
 
 for i, inputfile in enumerate(clamdata.inputfiles('foliainput')):
     cmdoptions = " --max-parser-tokens=200"
+    frogoptions = ["--max-parser-tokens=200"]
 
     if 'skip' in clamdata and clamdata['skip']:
         cmdoptions += ' --skip=' + "".join(clamdata['skip'])
+        frogoptions.append('--skip=' + "".join(clamdata['skip']))
 
-
-    clam.common.status.write(statusfile, "Processing " + os.path.basename(str(inputfile)))
     outputstem = os.path.basename(str(inputfile))
     if outputstem[-4:] == '.xml' or outputstem[-4:] == '.txt': outputstem = outputstem[:-4]
 
-    print("Invoking Frog",file=sys.stderr)
-    r = os.system(os.path.join(bindir, "frog") + " --language=nld " + shellsafe(cmdoptions) + " -x " + shellsafe(str(inputfile),'"') + " -X " + shellsafe(outputdir + outputstem + ".xml","'") + " -o " + shellsafe(outputdir + outputstem + ".frog.out","'") + " --threads=1")
-    if r != 0:
-        clam.common.status.write(statusfile, "Frog returned with an error whilst processing " + os.path.basename(str(inputfile) + " (FoLiA). Aborting"),100)
+    cachekey = None
+    if cache.enabled():
+        cachekey = cache.key("folia", hashfile(str(inputfile)), "".join(clamdata['skip']) if 'skip' in clamdata and clamdata['skip'] else "", False, None, version)
+        if cache.get(cachekey, outputfiles(outputdir + outputstem)):
+            print("Results for " + os.path.basename(str(inputfile)) + " retrieved from cache",file=sys.stderr)
+            continue
+
+    tasks.append( {'inputfile': str(inputfile), 'xmlinput': True, 'cmdoptions': cmdoptions, 'frogoptions': frogoptions + ["-x"], 'docid': None, 'outputprefix': outputdir + outputstem, 'outputstem': outputstem, 'cachekey': cachekey} )
+
+#run several Frog processes at once, bounded by the number of cores and the available memory
+workers = workercount(FROG_MAXWORKERS, FROG_WORKERMEMORY, len(tasks))
+if FROG_POOL_SIZE > 0:
+    workers = min(workers, FROG_POOL_SIZE)
+#if there are more cores than files, let each Frog use multiple threads
+threads = max(1, cpucount() // workers)
+print("Processing " + str(len(tasks)) + " file(s)/shard(s) using " + str(workers) + " worker(s) with " + str(threads) + " thread(s) each",file=sys.stderr)
+
+def processfile(task):
+    """Process a single input file (or shard), returns True on success"""
+    inputfile = task['inputfile']
+    clam.common.status.write(statusfile, "Processing " + os.path.basename(inputfile) + "...", round(done/len(tasks)*100))
+    print("Processing " + os.path.basename(inputfile) + "...", file=sys.stderr)
+
+    try:
+        if runfrog_pool(pool, inputfile, task['xmlinput'], task['frogoptions'], task['docid'], task['outputprefix']):
+            return True
+    except Exception as e: #pylint: disable=broad-except
+        print("\tProcessing " + os.path.basename(inputfile) + " with a Frog server failed: " + str(e), file=sys.stderr)
+
+    print("Invoking Frog on " + os.path.basename(inputfile),file=sys.stderr)
+    if task['xmlinput']:
+        inputoptions = " -x " + shellsafe(inputfile,'"')
+    else:
+        inputoptions = " -t " + shellsafe(inputfile,'"') + " --id=" + shellsafe(task['docid'],"'")
+    return call(os.path.join(bindir, "frog") + " --language=nld " + shellsafe(task['cmdoptions']) + inputoptions + " -X " + shellsafe(task['outputprefix'] + ".xml","'") + " -o " + shellsafe(task['outputprefix'] + ".frog.out","'") + " --threads=" + str(threads)) == 0
+
+done = 0
+for task, success in runparallel(processfile, tasks, workers):
+    if not success:
+        abort()
+        clam.common.status.write(statusfile, "Frog returned with an error whilst processing " + os.path.basename(task['inputfile']) + (" (FoLiA)" if task['xmlinput'] else " (plain text)") + ". Aborting",100)
         sys.exit(1)
+    done += 1
+    if task['cachekey']:
+        cache.put(task['cachekey'], outputfiles(task['outputprefix']))
+    clam.common.status.write(statusfile, "Processed " + str(done) + " of " + str(len(tasks)) + " file(s)/shard(s)", round(done/len(tasks)*100))
+    if task['outputstem'] in shards:
+        sharding = shards[task['outputstem']]
+        sharding['remaining'] -= 1
+        if sharding['remaining'] == 0:
+            #all shards are done, merge them back into a single document
+            print("Merging " + str(len(sharding['outputprefixes'])) + " shards for " + task['outputstem'],file=sys.stderr)
+            clam.common.status.write(statusfile, "Merging shards for " + task['outputstem'] + "...", round(done/len(tasks)*100))
+            mergefolia([ outputprefix + ".xml" for outputprefix in sharding['outputprefixes'] ], outputdir + task['outputstem'] + ".xml", sharding['docid'])
+            concatenate([ outputprefix + ".frog.out" for outputprefix in sharding['outputprefixes'] ], outputdir + task['outputstem'] + ".frog.out")
+            shutil.rmtree(sharding['dir'])
+            if sharding['cachekey']:
+                cache.put(sharding['cachekey'], outputfiles(outputdir + task['outputstem']))
+
+if cache.enabled():
+    print(cache.report(),file=sys.stderr)
 
 clam.common.status.write(statusfile, "Done",100)
 
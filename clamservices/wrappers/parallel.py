@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+#-*- coding:utf-8 -*-
+
+###############################################################
+# CLAM: Computational Linguistics Application Mediator
+# -- Bounded parallel execution for wrapper scripts --
+#       by Maarten van Gompel (proycon)
+#       http://proycon.github.io/clam/
+#       Centre for Language and Speech Technology  / Language Machines
+#       Radboud University Nijmegen
+#
+#       Licensed under GPLv3
+#
+###############################################################
+
+#Helpers for wrapper scripts that process multiple files (or parts of files)
+#at once. The number of workers is bounded by the configuration, the number of
+#available CPU cores and the available memory. Execution is fail-fast: as soon
+#as the caller stops consuming results all pending tasks are cancelled, and
+#abort() terminates all commands that are still running, as well as all worker
+#processes (and the commands they started).
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import os
+import time
+import signal
+import threading
+import subprocess
+import multiprocessing
+import multiprocessing.connection
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+_processes = set()
+_lock = threading.Lock()
+_aborted = threading.Event()
+_executors = set() #process pools that are in use, abort() terminates their workers
+
+#Time (in seconds) worker processes get to terminate the commands they started before they are killed by abort()
+ABORTTIMEOUT = 5
+
+def cpucount():
+    """Returns the number of CPU cores available to this process"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+def availablememory():
+    """Returns the available memory in MB, or None if it can not be determined"""
+    try:
+        with open('/proc/meminfo','r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+def workercount(maxworkers, workermemory=0, tasks=None):
+    """Determine the number of workers to use
+
+    Parameters:
+        * maxworkers - Configured maximum number of workers (0 = number of CPU cores)
+        * workermemory - Estimated peak memory usage of a single worker in MB (0 = do not take memory into account)
+        * tasks - Number of tasks, no more workers than tasks are used
+    """
+    n = cpucount()
+    if maxworkers > 0:
+        n = min(n, maxworkers)
+    if workermemory > 0:
+        memory = availablememory()
+        if memory is not None:
+            n = min(n, memory // workermemory)
+    if tasks is not None:
+        n = min(n, tasks)
+    return max(1, n)
+
+def runparallel(function, tasks, workers, processes=False):
+    """Run function(task) for all tasks on a pool of workers (threads, or processes if processes=True).
+
+    This is a generator yielding (task, result) tuples in order of completion. When the caller stops iterating (or
+    the function raises an exception) all pending tasks are cancelled, tasks that are already running are left to finish
+    unless abort() is called."""
+    if processes:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_initworker)
+        with _lock:
+            _executors.add(executor)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    futures = {}
+    try:
+        for task in tasks:
+            futures[executor.submit(function, task)] = task
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+        with _lock:
+            _executors.discard(executor)
+        executor.shutdown(wait=False)
+
+def _initworker():
+    """Initialises a worker process, so that terminating it (by abort() in the parent) terminates the commands it started as well"""
+    #forget the state inherited from the parent, the worker only terminates its own commands
+    _executors.clear()
+    _processes.clear()
+    signal.signal(signal.SIGTERM, _terminateworker)
+
+def _terminateworker(signum, frame): #pylint: disable=unused-argument
+    #runs in the main thread of the worker, which may hold the lock, but is also the only thread that starts commands
+    _aborted.set()
+    for process in list(_processes):
+        try:
+            process.terminate()
+        except OSError:
+            pass
+    os._exit(1) #pylint: disable=protected-access
+
+def call(cmd, output=None):
+    """Run a shell command and return its exit code (like os.system), the command can be terminated through abort().
+    The command should be a simple command (it is exec'ed by the shell), so no pipelines or variable assignments.
+    If output is given, it is called with every block of the standard output of the command as it is produced."""
+    if _aborted.is_set():
+        return -1
+    process = subprocess.Popen("exec " + cmd, shell=True, stdout=subprocess.PIPE if output is not None else None)
+    with _lock:
+        _processes.add(process)
+    try:
+        if output is not None:
+            with process.stdout:
+                try:
+                    for data in iter(lambda: os.read(process.stdout.fileno(), 65536), b""):
+                        output(data)
+                except BaseException:
+                    process.terminate() #the consumer failed, do not leave the command running
+                    raise
+        return process.wait()
+    finally:
+        with _lock:
+            _processes.discard(process)
+
+def measure(cmd):
+    """Run a shell command like call(), returns its exit code, its wall-clock duration (in seconds) and its peak memory
+    usage (maximum resident set size, in MB)"""
+    if _aborted.is_set():
+        return -1, 0, 0
+    begintime = time.time()
+    process = subprocess.Popen("exec " + cmd, shell=True)
+    with _lock:
+        _processes.add(process)
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    finally:
+        with _lock:
+            _processes.discard(process)
+    return process.returncode, time.time() - begintime, rusage.ru_maxrss / 1024
+
+def abort():
+    """Terminate all commands started through call() and all worker processes of runparallel(), and refuse to start new commands"""
+    _aborted.set()
+    with _lock:
+        for process in _processes:
+            try:
+                process.terminate()
+            except OSError:
+                pass
+        workers = [ worker for executor in _executors for worker in list((executor._processes or {}).values()) ] #pylint: disable=protected-access
+    for worker in workers:
+        try:
+            worker.terminate()
+        except OSError:
+            pass
+    #workers that are busy in native code (e.g. in-process processing through Python bindings) only handle the signal once that returns, kill them if they do not exit in time
+    deadline = time.time() + ABORTTIMEOUT
+    pending = dict( (worker.sentinel, worker) for worker in workers )
+    while pending and time.time() < deadline:
+        for sentinel in multiprocessing.connection.wait(list(pending), deadline - time.time()):
+            del pending[sentinel]
+    for worker in pending.values():
+        try:
+            os.kill(worker.pid, signal.SIGKILL)
+        except OSError:
+            pass
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+#-*- coding:utf-8 -*-
+
+###############################################################
+# CLAM: Computational Linguistics Application Mediator
+# -- Content-addressed cache of result files --
+#       by Maarten van Gompel (proycon)
+#       http://proycon.github.io/clam/
+#       Centre for Language and Speech Technology  / Language Machines
+#       Radboud University Nijmegen
+#
+#       Licensed under GPLv3
+#
+###############################################################
+
+#Users often resubmit the same data with the same options. Wrappers can store
+#the files they produced in this cache, keyed on a hash of the input data and
+#everything else that influences the result, and materialise them (by copy)
+#rather than recomputing them. The cache directory is shared between
+#jobs, entries are evicted in least-recently-used order once the cache exceeds
+#its size budget. Many small results, such as individual sentence parses, are
+#better kept in a BlobCache, a single SQLite database.
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import os
+import sys
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import sqlite3
+import threading
+
+def hashfile(filename, blocksize=1024*1024):
+    """Returns the SHA-1 hex digest of the contents of a file"""
+    h = hashlib.sha1()
+    with open(filename,'rb') as f:
+        while True:
+            data = f.read(blocksize)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def materialise(source, target):
+    """Make source available as target, by copy. Not by hardlink: the wrappers (and the tools they call) may later
+    write to an output file in place, which would also change the cache entry sharing its inode."""
+    if os.path.lexists(target):
+        os.unlink(target)
+    shutil.copyfile(source, target)
+
+class ResultCache(object):
+    """On-disk content-addressed cache of result files
+
+    Parameters:
+        * cachedir - The cache directory (shared between jobs)
+        * maxsize - Size budget of the cache in MB, 0 disables the cache
+    """
+
+    def __init__(self, cachedir, maxsize, log=sys.stderr):
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.log = log
+        self.hits = 0
+        self.misses = 0
+        if self.enabled() and not os.path.isdir(self.cachedir):
+            try:
+                os.makedirs(self.cachedir)
+            except OSError:
+                if not os.path.isdir(self.cachedir):
+                    raise
+
+    def enabled(self):
+        return self.maxsize > 0
+
+    @staticmethod
+    def key(*components):
+        """Compute a cache key from the given components (strings, numbers, booleans or None)"""
+        h = hashlib.sha1()
+        for component in components:
+            h.update(repr(component).encode('utf-8') + b"\0")
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cachedir, key)
+
+    def get(self, key, targets):
+        """Materialise a cached result. Targets is a dictionary mapping names of cached files to target paths. Returns True on a cache hit, False on a miss."""
+        if not self.enabled():
+            return False
+        entry = self._entry(key)
+        materialised = []
+        try:
+            for name, target in targets.items():
+                materialise(os.path.join(entry, name), target)
+                materialised.append(target)
+            os.utime(entry, None) #mark as recently used
+        except (IOError, OSError):
+            #do not leave a partial result behind
+            for target in materialised:
+                os.unlink(target)
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def put(self, key, sources):
+        """Store a result in the cache. Sources is a dictionary mapping names of cached files to the paths of the files to store."""
+        if not self.enabled():
+            return
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+        tmpdir = tempfile.mkdtemp(dir=self.cachedir, prefix='.tmp')
+        try:
+            for name, source in sources.items():
+                materialise(source, os.path.join(tmpdir, name))
+            os.rename(tmpdir, entry)
+        except (IOError, OSError) as e:
+            print("Unable to store result in cache: " + str(e), file=self.log)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache is within its size budget"""
+        with open(os.path.join(self.cachedir, '.lock'),'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            total = 0
+            for key in os.listdir(self.cachedir):
+                entry = self._entry(key)
+                if key[0] == '.' or not os.path.isdir(entry):
+                    continue
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                    entries.append((os.path.getmtime(entry), size, entry))
+                except OSError:
+                    continue
+                total += size
+            for _, size, entry in sorted(entries):
+                if total <= self.maxsize * 1024 * 1024:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def report(self):
+        """Returns a one-line summary of cache usage in this job"""
+        return "Cache: " + str(self.hits) + " hit(s), " + str(self.misses) + " miss(es)"
+
+
+class BlobCache(object):
+    """Persistent cache of many small results (e.g. per-sentence parses), stored in an SQLite database
+
+    Parameters:
+        * filename - The database file (shared between jobs)
+        * maxsize - Size budget of the cache in MB, 0 disables the cache. Least recently used entries are evicted once the cache exceeds it.
+
+    Database errors (e.g. the database being locked by other jobs for too long) are reported and count as cache misses,
+    they never make the caller fail.
+    """
+
+    EVICTINTERVAL = 1000 #check the size budget every so many insertions
+
+    def __init__(self, filename, maxsize, log=sys.stderr):
+        self.filename = filename
+        self.maxsize = maxsize
+        self.log = log
+        self.hits = 0
+        self.misses = 0
+        self.insertions = 0
+        self.used = {} #key => time of last use, for hits not yet recorded in the database (recorded in batch to avoid a write on every hit)
+        self.lock = threading.Lock()
+        self.db = None
+        if self.enabled():
+            try:
+                self.db = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+                self.db.execute("PRAGMA journal_mode=WAL") #readers and the writer do not block each other
+                self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, size INTEGER, lastused REAL)")
+                self.db.execute("CREATE INDEX IF NOT EXISTS cache_lastused ON cache (lastused)")
+                self.db.commit()
+            except sqlite3.Error as e:
+                print("Unable to open cache, disabling it: " + str(e), file=self.log)
+                self.db = None
+                self.maxsize = 0
+
+    def enabled(self):
+        return self.maxsize > 0
+
+    key = staticmethod(ResultCache.key)
+
+    def get(self, key):
+        """Returns the cached value, or None on a cache miss"""
+        if not self.enabled():
+            return None
+        with self.lock:
+            try:
+                row = self.db.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error as e:
+                print("Unable to read from cache: " + str(e), file=self.log)
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.used[key] = time.time()
+            self.hits += 1
+            return bytes(row[0])
+
+    def put(self, key, value):
+        if not self.enabled():
+            return
+        with self.lock:
+            try:
+                self.db.execute("INSERT OR REPLACE INTO cache (key, value, size, lastused) VALUES (?, ?, ?, ?)", (key, sqlite3.Binary(value), len(value), time.time()))
+                self.insertions += 1
+                if self.insertions % self.EVICTINTERVAL == 0:
+                    self._touch()
+                    self._evict()
+                self.db.commit()
+            except sqlite3.Error as e:
+                print("Unable to store result in cache: " + str(e), file=self.log)
+                self._rollback()
+
+    def _touch(self):
+        """Record the time of last use of all hits since the previous call"""
+        if self.used:
+            self.db.executemany("UPDATE cache SET lastused = ? WHERE key = ?", [ (lastused, key) for key, lastused in self.used.items() ])
+            self.used = {}
+
+    def _rollback(self):
+        try:
+            self.db.rollback()
+        except sqlite3.Error:
+            pass
+
+    def _evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(size),0) FROM cache").fetchone()[0]
+        budget = self.maxsize * 1024 * 1024
+        if total > budget:
+            #remove the least recently used entries until we are at 90% of the budget, so we don't have to evict on every insertion
+            excess = total - budget * 0.9
+            removed = 0
+            keys = []
+            for key, size in self.db.execute("SELECT key, size FROM cache ORDER BY lastused"):
+                if removed >= excess:
+                    break
+                keys.append((key,))
+                removed += size
+            self.db.executemany("DELETE FROM cache WHERE key = ?", keys)
+
+    def close(self):
+        if self.db is not None:
+            with self.lock:
+                try:
+                    self._touch()
+                    self._evict()
+                    self.db.commit()
+                except sqlite3.Error as e:
+                    print("Unable to update cache: " + str(e), file=self.log)
+                    self._rollback()
+                self.db.close()
+                self.db = None
+
+    def report(self):
+        """Returns a one-line summary of cache usage in this job"""
+        total = self.hits + self.misses
+        return "Cache: " + str(self.hits) + " of " + str(total) + " retrieved from cache (" + str(round(self.hits / total * 100 if total else 0,1)) + "% hit rate)"
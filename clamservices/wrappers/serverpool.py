@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+#-*- coding:utf-8 -*-
+
+###############################################################
+# CLAM: Computational Linguistics Application Mediator
+# -- Pool of long-lived server processes shared between jobs --
+#       by Maarten van Gompel (proycon)
+#       http://proycon.github.io/clam/
+#       Centre for Language and Speech Technology  / Language Machines
+#       Radboud University Nijmegen
+#
+#       Licensed under GPLv3
+#
+###############################################################
+
+#Tools like Frog and Alpino spend a lot of time loading their models on
+#startup. Rather than starting a new process for every input file, wrappers
+#can submit their work to a pool of resident servers. Each slot in the pool
+#is a single server process listening on its own TCP port. The state of every
+#slot is kept in a small JSON file in a state directory that is shared by all
+#jobs of a service, and access to a slot is serialised through an exclusive
+#file lock, so concurrent jobs never submit to the same server at once.
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import sys
+import os
+import json
+import time
+import fcntl
+import errno
+import signal
+import socket
+import subprocess
+from contextlib import contextmanager
+
+#Seconds a stopped server (or any other process still holding the port of a slot) gets to exit before it is killed
+STOPTIMEOUT = 10
+
+def portlisteners(port):
+    """Returns the set of PIDs of the processes listening on the given TCP port, or None if this can not be determined
+    (no /proc). Processes of other users may not be visible."""
+    inodes = set()
+    found = False
+    for filename in ('/proc/net/tcp','/proc/net/tcp6'):
+        try:
+            with open(filename,'r') as f:
+                found = True
+                next(f) #header
+                for line in f:
+                    fields = line.split()
+                    #fields: sl local_address rem_address st ... inode, state 0A is LISTEN
+                    if len(fields) > 9 and fields[3] == '0A' and int(fields[1].split(':')[1], 16) == port:
+                        inodes.add('socket:[' + fields[9] + ']')
+        except (IOError, OSError, StopIteration, ValueError):
+            continue
+    if not found:
+        return None
+    pids = set()
+    if not inodes:
+        return pids
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        fddir = os.path.join('/proc', pid, 'fd')
+        try:
+            for fd in os.listdir(fddir):
+                if os.readlink(os.path.join(fddir, fd)) in inodes:
+                    pids.add(int(pid))
+                    break
+        except OSError:
+            continue
+    return pids
+
+
+class ServerSlot(object):
+    """A single server in the pool, as handed out by ServerPool.acquire()"""
+
+    def __init__(self, pool, index, state):
+        self.pool = pool
+        self.index = index
+        self.state = state
+        self.host = pool.host
+        self.port = pool.baseport + index
+
+    def fail(self):
+        """Signal that the server misbehaved; it will be stopped and restarted on the next acquisition"""
+        self.pool._stop(self.state)
+        self.state['pid'] = None
+        self.state['signature'] = None
+
+
+class ServerPool(object):
+    """Pool of long-lived server processes
+
+    Parameters:
+        * statedir - Directory holding slot state, locks and server logs (shared between jobs)
+        * size - Number of servers in the pool, 0 disables the pool
+        * baseport - Port of the first slot, slot *i* listens on baseport + i
+        * starttimeout - Seconds to wait for a freshly started server to accept connections
+        * maxrestarts - Number of consecutive failed (re)starts after which a slot is disabled for ``retryafter`` seconds
+    """
+
+    def __init__(self, statedir, size, host='127.0.0.1', baseport=9000, starttimeout=300, maxrestarts=3, retryafter=600, log=sys.stderr):
+        self.statedir = statedir
+        self.size = size
+        self.host = host
+        self.baseport = baseport
+        self.starttimeout = starttimeout
+        self.maxrestarts = maxrestarts
+        self.retryafter = retryafter
+        self.log = log
+        if self.size > 0 and not os.path.isdir(self.statedir):
+            try:
+                os.makedirs(self.statedir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _statefile(self, index):
+        return os.path.join(self.statedir, 'slot' + str(index) + '.json')
+
+    def _readstate(self, index):
+        try:
+            with open(self._statefile(index), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {'pid': None, 'signature': None, 'failures': 0, 'disableduntil': 0, 'lastused': 0}
+
+    def _writestate(self, index, state):
+        tmpfile = self._statefile(index) + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmpfile, self._statefile(index))
+
+    def _order(self, signature):
+        """Order in which slots are tried: idle servers already running with the right signature first, then least recently used"""
+        states = [ (i, self._readstate(i)) for i in range(self.size) ]
+        return [ i for i, state in sorted(states, key=lambda x: (x[1].get('signature') != signature, x[1].get('lastused',0))) ]
+
+    def healthy(self, index, state):
+        """Health check: the server process must be alive, must be the one listening on its port, and must accept connections"""
+        if not state.get('pid'):
+            return False
+        try:
+            os.kill(state['pid'], 0)
+        except OSError:
+            return False
+        listeners = portlisteners(self.baseport + index)
+        if listeners is not None:
+            #a port that accepts connections is no proof by itself: an orphaned server (whose pid was lost) may still hold
+            #it. The server is started in a new session, so everything it runs has the recorded pid as session ID.
+            if not listeners:
+                return False
+            for pid in listeners:
+                try:
+                    if os.getsid(pid) != state['pid']:
+                        return False
+                except OSError:
+                    return False
+        try:
+            s = socket.create_connection((self.host, self.baseport + index), 5)
+            s.close()
+        except (socket.error, socket.timeout):
+            return False
+        return True
+
+    def _stop(self, state):
+        if state.get('pid'):
+            try:
+                os.killpg(state['pid'], signal.SIGTERM)
+            except OSError:
+                pass
+
+    def _portfree(self, port):
+        listeners = portlisteners(port)
+        if listeners is None:
+            #can not be determined, see whether anything accepts connections
+            try:
+                s = socket.create_connection((self.host, port), 5)
+                s.close()
+            except (socket.error, socket.timeout):
+                return True
+            return False
+        return not listeners
+
+    def _clearport(self, index):
+        """Make sure nothing (e.g. a stopped or orphaned server) is listening on the port of the slot anymore, returns False if it remains in use"""
+        port = self.baseport + index
+        begintime = time.time()
+        while not self._portfree(port):
+            if time.time() - begintime > STOPTIMEOUT * 2:
+                return False
+            for pid in portlisteners(port) or ():
+                print("Port " + str(port) + " of pool server " + str(index) + " is still held by process " + str(pid) + ", terminating it", file=self.log)
+                try:
+                    os.kill(pid, signal.SIGTERM if time.time() - begintime < STOPTIMEOUT else signal.SIGKILL)
+                except OSError:
+                    pass
+            time.sleep(1)
+        return True
+
+    def _start(self, index, signature, command, state):
+        self._stop(state)
+        state['pid'] = None
+        state['signature'] = None
+        port = self.baseport + index
+        if not self._clearport(index):
+            print("Port " + str(port) + " of pool server " + str(index) + " remains in use by another process, unable to start a server on it", file=self.log)
+            process = None
+        else:
+            cmd = command(port)
+            print("Starting pool server " + str(index) + " on port " + str(port) + ": " + " ".join(cmd), file=self.log)
+            with open(os.path.join(self.statedir, 'slot' + str(index) + '.log'), 'ab') as logfile:
+                #start in a new session so the server survives the job (and is not killed along with it)
+                process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=logfile, stderr=subprocess.STDOUT, start_new_session=True)
+            state['pid'] = process.pid
+            state['signature'] = signature
+            #record the server immediately, so it can still be stopped if this job is killed while holding the slot
+            self._writestate(index, state)
+            begintime = time.time()
+            while time.time() - begintime < self.starttimeout:
+                if process.poll() is not None:
+                    break
+                if self.healthy(index, state):
+                    state['failures'] = 0
+                    self._writestate(index, state)
+                    return True
+                time.sleep(1)
+        print("Pool server " + str(index) + " failed to start", file=self.log)
+        self._stop(state)
+        state['pid'] = None
+        state['signature'] = None
+        state['failures'] = state.get('failures',0) + 1
+        if state['failures'] >= self.maxrestarts:
+            print("Pool server " + str(index) + " failed " + str(state['failures']) + " times in a row, disabling it for " + str(self.retryafter) + "s", file=self.log)
+            state['disableduntil'] = time.time() + self.retryafter
+            state['failures'] = 0
+        return False
+
+    @contextmanager
+    def acquire(self, signature, command, timeout=3600):
+        """Acquire a server for exclusive use, context manager yielding a ServerSlot, or None if no server could be made available (the caller should fall back to running the tool directly).
+
+        Parameters:
+            * signature - String identifying the startup options of the server, servers with a different signature are restarted
+            * command - Function taking a port number and returning the command (list) that starts a server on that port
+            * timeout - Maximum number of seconds to wait for a slot to become free
+        """
+        lockfile = None
+        index = None
+        state = None
+        begintime = time.time()
+        while self.size > 0 and index is None:
+            available = False
+            for i in self._order(signature):
+                f = open(os.path.join(self.statedir, 'slot' + str(i) + '.lock'), 'a')
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    f.close()
+                    available = True #busy, but may become free later
+                    continue
+                state = self._readstate(i)
+                if state.get('disableduntil',0) > time.time():
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                    f.close()
+                    continue
+                available = True
+                if (state.get('signature') == signature and self.healthy(i, state)) or self._start(i, signature, command, state):
+                    lockfile = f
+                    index = i
+                    break
+                self._writestate(i, state)
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+            if index is None:
+                if not available or time.time() - begintime > timeout:
+                    break
+                time.sleep(1)
+
+        if index is None:
+            yield None
+            return
+
+        try:
+            yield ServerSlot(self, index, state)
+        finally:
+            state['lastused'] = time.time()
+            self._writestate(index, state)
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+            lockfile.close()
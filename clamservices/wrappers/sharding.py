@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+#-*- coding:utf-8 -*-
+
+###############################################################
+# CLAM: Computational Linguistics Application Mediator
+# -- Splitting large documents and merging the results --
+#       by Maarten van Gompel (proycon)
+#       http://proycon.github.io/clam/
+#       Centre for Language and Speech Technology  / Language Machines
+#       Radboud University Nijmegen
+#
+#       Licensed under GPLv3
+#
+###############################################################
+
+#Large plain-text documents can be split into shards at paragraph (or
+#sentence) boundaries, so the shards can be processed in parallel. The FoLiA
+#documents produced for the shards (all with the same document ID) are merged
+#back into one document, renumbering the structural elements so IDs are
+#unique, stable and in the original order.
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import re
+import io
+import shutil
+
+SENTENCEFINAL = re.compile(br'[.!?]["\')\]]*\s*$')
+
+def splittext(filename, shardsize, outputprefix, sentenceperline=False):
+    """Split a plain text file into shards of roughly shardsize bytes.
+
+    Shards end at a paragraph boundary (a blank line), or at any line if sentenceperline is set. If no paragraph
+    boundary is found for twice the shard size, the shard ends at the first line that ends a sentence, and as a last
+    resort at any line. Returns the list of shard filenames (outputprefix + .N.txt)."""
+    shards = []
+    out = None
+    size = 0
+    with open(filename,'rb') as f:
+        for line in f:
+            if out is None:
+                shards.append(outputprefix + "." + str(len(shards)+1) + ".txt")
+                out = open(shards[-1],'wb')
+                size = 0
+            out.write(line)
+            size += len(line)
+            if size >= shardsize and (sentenceperline or not line.strip() or (size >= 2 * shardsize and SENTENCEFINAL.search(line)) or size >= 4 * shardsize):
+                out.close()
+                out = None
+    if out is not None:
+        out.close()
+    return shards
+
+def concatenate(filenames, outputfile):
+    """Concatenate files (in order) into one output file"""
+    with open(outputfile,'wb') as out:
+        for filename in filenames:
+            with open(filename,'rb') as f:
+                shutil.copyfileobj(f, out)
+
+def mergefolia(filenames, outputfile, docid):
+    """Merge FoLiA documents produced for the shards of a single document (in order) into one FoLiA document.
+
+    All shard documents must have the same document ID (docid). The numbered structural elements directly under the
+    text body (paragraphs, sentences, etc) are renumbered, along with everything below them, so their IDs continue
+    where the previous shard left off. This operates in a streaming fashion on the serialised XML so even very large
+    documents can be merged without loading them into memory."""
+    idpattern = re.compile(r'((?:xml:)?id=")' + re.escape(docid) + r'\.([A-Za-z]+)\.(\d+)(?=[."])')
+    offsets = {} #element type => offset
+    with io.open(outputfile,'w',encoding='utf-8') as out:
+        for i, filename in enumerate(filenames):
+            last = i == len(filenames) - 1
+            highest = {}
+            def renumber(match):
+                number = int(match.group(3))
+                highest[match.group(2)] = max(highest.get(match.group(2),0), number)
+                return match.group(1) + docid + "." + match.group(2) + "." + str(number + offsets.get(match.group(2),0))
+            state = 'header'
+            with io.open(filename,'r',encoding='utf-8') as f:
+                for line in f:
+                    if state == 'header':
+                        match = re.search(r'<text[\s>][^>]*>', line)
+                        if match:
+                            #the header (everything up to and including the <text> tag) is taken from the first shard only
+                            if i == 0:
+                                out.write(line[:match.end()])
+                            line = line[match.end():]
+                            state = 'body'
+                        elif i == 0:
+                            out.write(line)
+                    if state == 'body':
+                        end = line.find('</text>')
+                        if end != -1:
+                            out.write(idpattern.sub(renumber, line[:end]))
+                            line = line[end:]
+                            state = 'footer'
+                        else:
+                            out.write(idpattern.sub(renumber, line))
+                    if state == 'footer' and last:
+                        out.write(line)
+            for elementtype, number in highest.items():
+                offsets[elementtype] = offsets.get(elementtype,0) + number
@@ -30,53 +30,119 @@ import clam.common.parameters
 import clam.common.formats
 
 import spacy
+import folia.main as folia
+from spacy2folia.spacy2folia import convert, get_processor, process_sentence, WhitespaceTokenizer, SETPREFIX
 
-shellsafe = clam.common.data.shellsafe
-
-#this script takes three arguments: $DATAFILE $STATUSFILE $OUTPUTDIRECTORY
-datafile = sys.argv[1]
-statusfile = sys.argv[2]
-outputdir = sys.argv[3]
-
-
-#os.environ['PYTHONPATH'] = bindir + '/../lib/python' + str(sys.version_info.major) + '.' + str(sys.version_info.minor) + '/site-packages/frog' #Necessary for University of Tilburg servers (change or remove this in your own setup)
-
-#Obtain all data from the CLAM system (passed in $DATAFILE (clam.xml))
-clamdata = clam.common.data.getclamdata(datafile)
-
-#You now have access to all data. A few properties at your disposition now are:
-# clamdata.system_id , clamdata.project, clamdata.user, clamdata.status , clamdata.parameters, clamdata.inputformats, clamdata.outputformats , clamdata.input , clamdata.output
-
-clam.common.status.write(statusfile, "Starting...")
+from clamservices.config.spacy import SPACY_BATCHSIZE, SPACY_PROCESSES, SPACY_WORKERMEMORY
+from clamservices.wrappers.parallel import workercount
 
-inputfiles = []
-for i, inputfile in enumerate(clamdata.inputfiles('textinput')):
-    inputfiles.append(inputfile)
-for i, inputfile in enumerate(clamdata.inputfiles('foliainput')):
-    inputfiles.append(inputfile)
-
-models = {}
-for lang in spacy.info()['Models'].split(','):
-    lang = lang.strip()
-    model = spacy.info(lang)
-    if lang not in models:
-        models[lang] =  lang + "_" + model['name']
-
-clam.common.status.write(statusfile, "Processing ...")
-
-if clamdata['model'] in models:
-    model = models[clamdata['model']]
-else:
-    model = clamdata['model']
-
-inputfilepaths = [ os.path.abspath(str(inputfile)) for inputfile in inputfiles ]
-
-os.chdir(outputdir) #spacy2folia writes in current working directory
-r = os.system("spacy2folia --model " + shellsafe(model) + " " + " ".join(( shellsafe(f,) for f in inputfilepaths )))
-if r != 0:
-    clam.common.status.write(statusfile, "Spacy returned with an error whilst processing. Aborting",100)
-    sys.exit(1)
-
-clam.common.status.write(statusfile, "Done",100)
+shellsafe = clam.common.data.shellsafe
 
-sys.exit(0) #non-zero exit codes indicate an error!
+def documentid(filename):
+    """Derive a valid document ID from a filename (as spacy2folia does)"""
+    docid = ".".join(os.path.basename(filename).replace(" ","_").split(".")[:-1])
+    if not folia.isncname(docid):
+        if docid[0].isnumeric():
+            docid = "D" + docid
+        docid = docid.replace(":","_").replace(" ","_")
+    return docid
+
+def readtexts(filenames):
+    """Generator over (text, document ID) tuples for plain text files, read only when the pipeline asks for them"""
+    for filename in filenames:
+        with open(filename,'r',encoding='utf-8') as f:
+            yield f.read(), documentid(filename)
+
+def annotate_folia(foliadoc, nlp, default_tokenizer, batchsize):
+    """Annotate an existing FoLiA document, like spacy2folia's convert_folia() does, but passing all its sentences
+    (or paragraphs) through the pipeline in batches"""
+    nlp.tokenizer = default_tokenizer
+    if not foliadoc.processor or foliadoc.processor.name != "spacy2folia":
+        foliadoc.processor = get_processor(nlp, None, SETPREFIX)
+    if foliadoc.declared(folia.Sentence):
+        print("Sentence annotation is present in " + foliadoc.id + ", annotating on the sentence level",file=sys.stderr)
+        pretokenized = foliadoc.declared(folia.Word)
+        if pretokenized:
+            print("Token annotation is already present in " + foliadoc.id + ", disabling SpaCy's tokeniser and working on the existing tokens!",file=sys.stderr)
+            nlp.tokenizer = WhitespaceTokenizer(nlp.vocab)
+        sentences = list(foliadoc.sentences())
+        texts = ( sentence.text(retaintokenisation=pretokenized).replace("\n"," ").strip() for sentence in sentences )
+        for sentence, doc in zip(sentences, nlp.pipe(texts, batch_size=batchsize)):
+            process_sentence(foliadoc, doc, None, sentence, SETPREFIX, do_paragraphs=False, pretokenized=pretokenized)
+    elif foliadoc.declared(folia.Paragraph):
+        print("Paragraph annotation is present in " + foliadoc.id + ", annotating on the paragraph level",file=sys.stderr)
+        paragraphs = list(foliadoc.paragraphs())
+        texts = ( paragraph.text().replace("\n"," ").strip() for paragraph in paragraphs )
+        for paragraph, doc in zip(paragraphs, nlp.pipe(texts, batch_size=batchsize)):
+            for sentence in doc.sents:
+                process_sentence(foliadoc, sentence, paragraph, None, SETPREFIX, do_paragraphs=False)
+    else:
+        print("Nothing to do for document " + foliadoc.id + "? Couldn't find any existing structural basis to annotate.",file=sys.stderr)
+    return foliadoc
+
+
+if __name__ == "__main__":
+    #this script takes three arguments: $DATAFILE $STATUSFILE $OUTPUTDIRECTORY
+    datafile = sys.argv[1]
+    statusfile = sys.argv[2]
+    outputdir = sys.argv[3]
+
+
+    #os.environ['PYTHONPATH'] = bindir + '/../lib/python' + str(sys.version_info.major) + '.' + str(sys.version_info.minor) + '/site-packages/frog' #Necessary for University of Tilburg servers (change or remove this in your own setup)
+
+    #Obtain all data from the CLAM system (passed in $DATAFILE (clam.xml))
+    clamdata = clam.common.data.getclamdata(datafile)
+
+    #You now have access to all data. A few properties at your disposition now are:
+    # clamdata.system_id , clamdata.project, clamdata.user, clamdata.status , clamdata.parameters, clamdata.inputformats, clamdata.outputformats , clamdata.input , clamdata.output
+
+    clam.common.status.write(statusfile, "Starting...")
+
+    textfiles = [ os.path.abspath(str(inputfile)) for inputfile in clamdata.inputfiles('textinput') ]
+    foliafiles = [ os.path.abspath(str(inputfile)) for inputfile in clamdata.inputfiles('foliainput') ]
+
+    models = {}
+    for lang in spacy.info()['Models'].split(','):
+        lang = lang.strip()
+        model = spacy.info(lang)
+        if lang not in models:
+            models[lang] =  lang + "_" + model['name']
+
+    if clamdata['model'] in models:
+        model = models[clamdata['model']]
+    else:
+        model = clamdata['model']
+
+    clam.common.status.write(statusfile, "Loading model " + model + "...")
+    try:
+        #the model is loaded once and used for all documents
+        nlp = spacy.load(model)
+        default_tokenizer = nlp.tokenizer
+
+        total = len(textfiles) + len(foliafiles)
+        done = 0
+
+        if textfiles:
+            #plain text documents are streamed through the pipeline in batches, by multiple processes if there are enough documents
+            processes = workercount(SPACY_PROCESSES, SPACY_WORKERMEMORY, len(textfiles))
+            print("Processing " + str(len(textfiles)) + " text document(s) using " + str(processes) + " process(es)",file=sys.stderr)
+            for doc, docid in nlp.pipe(readtexts(textfiles), as_tuples=True, batch_size=SPACY_BATCHSIZE, n_process=processes):
+                foliadoc = convert(doc, docid, nlp, paragraphs=True)
+                foliadoc.save(os.path.join(outputdir, docid + ".folia.xml"))
+                done += 1
+                clam.common.status.write(statusfile, "Processed " + docid + " (" + str(done) + " of " + str(total) + ")", round((done/total)*100))
+
+        for filename in foliafiles:
+            foliadoc = folia.Document(file=filename, autodeclare=True, processor=get_processor(nlp, None, SETPREFIX))
+            foliadoc = annotate_folia(foliadoc, nlp, default_tokenizer, SPACY_BATCHSIZE)
+            foliadoc.save(os.path.join(outputdir, os.path.basename(foliadoc.filename)))
+            done += 1
+            clam.common.status.write(statusfile, "Processed " + os.path.basename(filename) + " (" + str(done) + " of " + str(total) + ")", round((done/total)*100))
+    except Exception as e: #pylint: disable=broad-except
+        print("Error: " + str(e),file=sys.stderr)
+        clam.common.status.write(statusfile, "Spacy returned with an error whilst processing. Aborting",100)
+        sys.exit(1)
+
+    clam.common.status.write(statusfile, "Done",100)
+
+    sys.exit(0) #non-zero exit codes indicate an error!
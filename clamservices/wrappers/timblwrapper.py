@@ -5,33 +5,438 @@ from __future__ import print_function, unicode_literals, division, absolute_impo
 
 import sys
 import os
-
-statusfile = sys.argv[1]
-inputdir = sys.argv[2]
-outputdir = sys.argv[3]
-parameters = ' '.join(sys.argv[4:])
-
+import io
 import glob
+import time
+import csv
+import shutil
+import itertools
+
 from clam.common.data import shellsafe
 
+from clamservices.config.timbl import TIMBL_MAXWORKERS, TIMBL_SHARDSIZE, TIMBL_CACHE_SIZE, TIMBL_CACHE_DIR, \
+    TIMBL_BENCHMARK_GRID, TIMBL_BENCHMARK_TRAINSAMPLE, TIMBL_BENCHMARK_TESTSAMPLE, TIMBL_BENCHMARK_MAXWORKERS
+from clamservices.wrappers.resultcache import ResultCache, hashfile
+from clamservices.wrappers.parallel import workercount, runparallel, call, measure, abort
+from clamservices.wrappers.sharding import splittext, concatenate
+
+#Weightings (-w) and their number in a weights file saved by Timbl (-W)
+WEIGHTS = {'nw': 0, 'gr': 1, 'ig': 2, 'x2': 3, 'sv': 4, 'sd': 5}
+
+#Feature metrics that use value difference matrices, which are not stored in the instance base
+VDMMETRICS = ('M','J','S')
+
+#Options that affect the trained instance base and weights, these make up the cache key along with the training data
+TRAINOPTIONS = ('-a','-k','-w','-m','-d','-s','-F')
+
+#Options that are handled by this wrapper rather than passed on to Timbl
+WRAPPEROPTIONS = ('--folds','--evaluate','--benchmark')
+
+#Field separators of the input formats whose output can be evaluated (None = any whitespace)
+SEPARATORS = {'Columns': None, 'Tabbed': b'\t', 'C4.5': b','}
+
+def parseoptions(args):
+    """Parse the Timbl options passed by CLAM into a list of [flag, value] pairs (value is None for flags without a value)"""
+    options = []
+    for arg in args:
+        if arg.startswith('-') and len(arg) > 1:
+            options.append([arg, None])
+        elif options and options[-1][1] is None:
+            options[-1][1] = arg
+        else:
+            options.append([arg, None])
+    return options
+
+def getoption(options, flag):
+    """Returns the value of the given option, or None if it is not set"""
+    for f, value in options:
+        if f == flag:
+            return value
+    return None
+
+def timblargs(options, exclude=()):
+    """Returns the options as a (shell-safe) string of command line arguments for Timbl, excluding the given flags"""
+    args = []
+    for flag, value in options:
+        if flag in exclude or flag in WRAPPEROPTIONS:
+            continue
+        args.append(flag)
+        if value is not None:
+            args.append(shellsafe(value,"'"))
+    return ' '.join(args)
 
-trainfile = None
-for inputfile in glob.glob(inputdir + '/*.train'):
-    trainfile = inputfile
+def traincommand(trainfile, options, prefix):
+    """Returns the command to train an instance base on the training data and save it, along with the feature weights
+    (and value difference matrices, if the metric needs them), under the given prefix"""
+    cmd = 'timbl -f ' + shellsafe(trainfile,"'") + ' ' + timblargs(options, exclude=('-t',)) + ' -I ' + shellsafe(prefix + '.ibase',"'") + ' -W ' + shellsafe(prefix + '.wgt',"'")
+    if getoption(options, '-m') in VDMMETRICS:
+        cmd += ' -U ' + shellsafe(prefix + '.arr',"'")
+    return cmd
 
-if not trainfile:
-    print("No trainfile found",file=sys.stderr)
+def train(trainfile, options, prefix):
+    """Train an instance base and save it under the given prefix, returns True on success"""
+    cmd = traincommand(trainfile, options, prefix)
+    print("Training: " + cmd,file=sys.stderr)
+    return os.system(cmd) == 0
 
-for testfile in glob.glob(inputdir + '/*.test'):
-    outfile = outputdir + '/' + os.path.basename(testfile).split('.')[0] + '.timblout'
-    cmd = 'timbl -f ' + shellsafe(trainfile,"'") + ' ' + parameters + ' -t ' + shellsafe(testfile,"'") + ' -o ' + shellsafe(outfile,"'")
+def instancebasefiles(prefix, options):
+    """Returns the files of a saved instance base, for storing in/retrieving from the cache"""
+    extensions = ['ibase','wgt','traintime']
+    if getoption(options, '-m') in VDMMETRICS:
+        extensions.append('arr')
+    return dict( (extension, prefix + '.' + extension) for extension in extensions )
+
+def cachedtrain(cache, trainfile, options, prefix):
+    """Obtain a trained instance base from the cache, or train it and store it in the cache. Returns True on success."""
+    cachekey = None
+    if cache.enabled():
+        cachekey = cache.key("instancebase", hashfile(trainfile), [ (flag, value) for flag, value in options if flag in TRAINOPTIONS ])
+        begintime = time.time()
+        if cache.get(cachekey, instancebasefiles(prefix, options)):
+            with io.open(prefix + '.traintime','r',encoding='utf-8') as f:
+                traintime = float(f.read())
+            print("Instance base retrieved from cache in " + str(round(time.time() - begintime,2)) + "s, training it took " + str(round(traintime,2)) + "s",file=sys.stderr)
+            return True
+    begintime = time.time()
+    if not train(trainfile, options, prefix):
+        return False
+    traintime = time.time() - begintime
+    print("Trained instance base in " + str(round(traintime,2)) + "s",file=sys.stderr)
+    if cachekey:
+        with io.open(prefix + '.traintime','w',encoding='utf-8') as f:
+            f.write(str(traintime))
+        cache.put(cachekey, instancebasefiles(prefix, options))
+    return True
+
+def testcommand(prefix, options, testfile, outfile):
+    """Returns the command to classify a test file against a saved instance base"""
+    weighting = getoption(options, '-w') or 'gr'
+    cmd = 'timbl -i ' + shellsafe(prefix + '.ibase',"'") + ' -w ' + shellsafe(prefix + '.wgt:' + str(WEIGHTS.get(weighting,1)),"'") + ' ' + timblargs(options, exclude=('-t','-w'))
+    if getoption(options, '-m') in VDMMETRICS:
+        cmd += ' -u ' + shellsafe(prefix + '.arr',"'")
+    return cmd + ' -t ' + shellsafe(testfile,"'") + ' -o ' + shellsafe(outfile,"'")
+
+def classify(task):
+    """Classify a test file (or shard) against the saved instance base, returns True on success. Runs in a worker thread."""
+    prefix, options, testfile, outfile, _ = task
+    cmd = testcommand(prefix, options, testfile, outfile)
     print("Processing " + testfile + ": " + cmd,file=sys.stderr)
-    os.system(cmd)
+    return call(cmd) == 0
+
+def fieldcount(testfile, separator):
+    """Returns the number of fields (features and class) of the instances in a test file"""
+    with open(testfile,'rb') as f:
+        for line in f:
+            if line.strip():
+                return len(line.strip().split(separator))
+    return 0
+
+def evaluate(outputfile, testfile, separator):
+    """Stream over a Timbl output file, returns the number of correctly classified instances, the total number of
+    instances and the confusion counts ((gold, predicted) => count)"""
+    n = fieldcount(testfile, separator)
+    correct = total = 0
+    confusion = {}
+    with open(outputfile,'rb') as f:
+        for line in f:
+            if line.startswith(b'#'):
+                #nearest neighbours (-v n) and other comments
+                continue
+            fields = line.strip().split(separator)
+            if len(fields) <= n:
+                continue
+            #the gold class is the last field of the instance, the predicted class follows it. Any -v extras (di, db, cf)
+            #are appended with spaces, so for C4.5 and Tabbed input they end up in the same field as the predicted class
+            predicted = fields[n].split()
+            if not predicted:
+                continue
+            pair = (fields[n-1].strip(), predicted[0])
+            confusion[pair] = confusion.get(pair,0) + 1
+            total += 1
+            if pair[0] == pair[1]:
+                correct += 1
+    return correct, total, confusion
+
+def writeevaluation(prefix, correct, total, confusion):
+    """Write the accuracy, the per-class precision, recall and F-score, and the confusion matrix as CSV files (prefix + .accuracy.csv, .classstats.csv, .confusion.csv)"""
+    classes = sorted(set(pair[0] for pair in confusion) | set(pair[1] for pair in confusion))
+    gold = dict( (cls, 0) for cls in classes )
+    predicted = dict( (cls, 0) for cls in classes )
+    for (goldcls, predictedcls), count in confusion.items():
+        gold[goldcls] += count
+        predicted[predictedcls] += count
+    scores = {}
+    for cls in classes:
+        tp = confusion.get((cls, cls),0)
+        precision = tp / predicted[cls] if predicted[cls] else 0
+        recall = tp / gold[cls] if gold[cls] else 0
+        scores[cls] = (precision, recall, 2 * precision * recall / (precision + recall) if precision + recall else 0)
+
+    with io.open(prefix + '.accuracy.csv','w',encoding='utf-8',newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['instances','correct','accuracy','macro_precision','macro_recall','macro_f1'])
+        writer.writerow([total, correct, round(correct / total if total else 0,6)] + [ round(sum(score[i] for score in scores.values()) / len(scores) if scores else 0,6) for i in range(3) ])
+    with io.open(prefix + '.classstats.csv','w',encoding='utf-8',newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['class','gold','predicted','correct','precision','recall','f1'])
+        for cls in classes:
+            writer.writerow([cls.decode('utf-8','replace'), gold[cls], predicted[cls], confusion.get((cls, cls),0)] + [ round(score,6) for score in scores[cls] ])
+    with io.open(prefix + '.confusion.csv','w',encoding='utf-8',newline='') as f:
+        #rows are gold classes, columns are predicted classes
+        writer = csv.writer(f)
+        writer.writerow(['gold/predicted'] + [ cls.decode('utf-8','replace') for cls in classes ])
+        for goldcls in classes:
+            writer.writerow([goldcls.decode('utf-8','replace')] + [ confusion.get((goldcls, predictedcls),0) for predictedcls in classes ])
+
+def crossvalidate(trainfile, options, folds, outputdir, doevaluate=False):
+    """Partition the training data into folds, train and test all folds in parallel and summarise the results. Returns True on success."""
+    separator = SEPARATORS[getoption(options, '-F') or 'Columns']
+    base = outputdir + '/' + os.path.basename(trainfile).split('.')[0]
+    foldsdir = outputdir + '/.folds'
+    if not os.path.isdir(foldsdir):
+        os.mkdir(foldsdir)
+
+    #instances are distributed over the folds round-robin
+    foldfiles = [ open(foldsdir + '/' + str(i+1) + '.test','wb') for i in range(folds) ]
+    with open(trainfile,'rb') as f:
+        i = 0
+        for line in f:
+            if line.strip():
+                foldfiles[i % folds].write(line)
+                i += 1
+    for foldfile in foldfiles:
+        foldfile.close()
+    for i in range(folds):
+        #the training data of a fold is made up of all other folds
+        concatenate([ foldsdir + '/' + str(j+1) + '.test' for j in range(folds) if j != i ], foldsdir + '/' + str(i+1) + '.train')
+
+    tasks = [ (foldsdir + '/' + str(i+1) + '.train', options, foldsdir + '/' + str(i+1) + '.test', base + '.fold' + str(i+1) + '.timblout') for i in range(folds) ]
+    workers = workercount(TIMBL_MAXWORKERS, 3 * os.path.getsize(trainfile) // (1024*1024), folds)
+    print("Cross-validating with " + str(folds) + " folds using " + str(workers) + " worker(s)",file=sys.stderr)
+    for task, success in runparallel(trainandtest, tasks, workers):
+        if not success:
+            print("Cross-validation fold " + task[2] + " failed",file=sys.stderr)
+            abort()
+            return False
+
+    #summarise the results of all folds
+    totalcorrect = totalinstances = 0
+    totalconfusion = {}
+    with io.open(base + '.crossvalidation.txt','w',encoding='utf-8') as out:
+        out.write(str(folds) + "-fold cross-validation of " + os.path.basename(trainfile) + "\n\n")
+        for i, task in enumerate(tasks):
+            correct, total, confusion = evaluate(task[3], task[2], separator)
+            out.write("Fold " + str(i+1) + ": accuracy " + str(round(correct / total if total else 0,6)) + " (" + str(correct) + " of " + str(total) + ")\n")
+            totalcorrect += correct
+            totalinstances += total
+            for pair, count in confusion.items():
+                totalconfusion[pair] = totalconfusion.get(pair,0) + count
+        out.write("Overall: accuracy " + str(round(totalcorrect / totalinstances if totalinstances else 0,6)) + " (" + str(totalcorrect) + " of " + str(totalinstances) + ")\n\n")
+        out.write("Confusion matrix (rows: gold class, columns: predicted class)\n")
+        classes = sorted(set(pair[0] for pair in totalconfusion) | set(pair[1] for pair in totalconfusion))
+        out.write("\t" + "\t".join(cls.decode('utf-8','replace') for cls in classes) + "\n")
+        for gold in classes:
+            out.write(gold.decode('utf-8','replace') + "\t" + "\t".join(str(totalconfusion.get((gold, predicted),0)) for predicted in classes) + "\n")
+    if doevaluate:
+        writeevaluation(base + '.crossvalidation', totalcorrect, totalinstances, totalconfusion)
+    shutil.rmtree(foldsdir)
+    return True
+
+def trainandtest(task):
+    """Train on the training data of a fold and test on its test data, returns True on success. Runs in a worker thread."""
+    trainfile, options, testfile, outfile = task
+    cmd = 'timbl -f ' + shellsafe(trainfile,"'") + ' ' + timblargs(options, exclude=('-t',)) + ' -t ' + shellsafe(testfile,"'") + ' -o ' + shellsafe(outfile,"'")
+    print("Processing " + testfile + ": " + cmd,file=sys.stderr)
+    return call(cmd) == 0
+
+def sample(filename, size, outputfile, heldoutfile=None, heldoutsize=0):
+    """Write a sample of size instances, evenly spread over the given file, to the output file. If a held-out file is
+    given, another heldoutsize instances are sampled and written to it. Returns the number of instances written to both."""
+    with open(filename,'rb') as f:
+        total = sum(1 for line in f if line.strip())
+    step = max(1, total // (size + heldoutsize))
+    period = (size + heldoutsize) // heldoutsize if heldoutsize else 0 #every period-th sampled instance is held out
+    written = heldout = 0
+    with open(filename,'rb') as f, open(outputfile,'wb') as out:
+        heldoutout = open(heldoutfile,'wb') if heldoutfile else None
+        i = 0
+        for line in f:
+            if not line.strip():
+                continue
+            if i % step == 0:
+                if heldoutout and (i // step) % period == period - 1 and heldout < heldoutsize:
+                    heldoutout.write(line)
+                    heldout += 1
+                elif written < size:
+                    out.write(line)
+                    written += 1
+            i += 1
+        if heldoutout:
+            heldoutout.close()
+    return written, heldout
+
+def benchmarkrun(task):
+    """Train and test a single setting of the benchmark grid. Returns the training time, classification time, peak
+    memory usage and accuracy (None if it can not be computed), or None if Timbl failed. Runs in a worker thread."""
+    _, options, trainfile, testfile, prefix = task
+    r, traintime, trainrss = measure(traincommand(trainfile, options, prefix))
+    if r != 0:
+        return None
+    r, testtime, testrss = measure(testcommand(prefix, options, testfile, prefix + '.out'))
+    if r != 0:
+        return None
+    accuracy = None
+    if (getoption(options, '-F') or 'Columns') in SEPARATORS:
+        correct, total, _ = evaluate(prefix + '.out', testfile, SEPARATORS[getoption(options, '-F') or 'Columns'])
+        accuracy = correct / total if total else 0
+    return traintime, testtime, max(trainrss, testrss), accuracy
+
+def benchmark(trainfile, testfiles, options, outputdir):
+    """Benchmark all settings of the grid on a sample of the data, in parallel, and write the results as a table"""
+    benchmarkdir = outputdir + '/.benchmark'
+    if not os.path.isdir(benchmarkdir):
+        os.mkdir(benchmarkdir)
+    trainsample = benchmarkdir + '/sample.train'
+    testsample = benchmarkdir + '/sample.test'
+    if testfiles:
+        trainsize, _ = sample(trainfile, TIMBL_BENCHMARK_TRAINSAMPLE, trainsample)
+        testsize, _ = sample(testfiles[0], TIMBL_BENCHMARK_TESTSAMPLE, testsample)
+    else:
+        #no test data, hold out part of the training data
+        trainsize, testsize = sample(trainfile, TIMBL_BENCHMARK_TRAINSAMPLE, trainsample, testsample, TIMBL_BENCHMARK_TESTSAMPLE)
+    print("Benchmarking on " + str(trainsize) + " training instances and " + str(testsize) + " test instances",file=sys.stderr)
+
+    flags = [ flag for flag, _ in TIMBL_BENCHMARK_GRID ]
+    tasks = []
+    for i, values in enumerate(itertools.product(*[ values for _, values in TIMBL_BENCHMARK_GRID ])):
+        #the grid settings replace the user's choices, all other options are kept
+        taskoptions = [ option for option in options if option[0] not in flags and option[0] != '-t' ] + [ [flag, value] for flag, value in zip(flags, values) ]
+        tasks.append( (values, taskoptions, trainsample, testsample, benchmarkdir + '/' + str(i)) )
+
+    workers = workercount(TIMBL_BENCHMARK_MAXWORKERS, 3 * os.path.getsize(trainsample) // (1024*1024), len(tasks))
+    print("Benchmarking " + str(len(tasks)) + " settings using " + str(workers) + " worker(s)",file=sys.stderr)
+    results = {}
+    for task, result in runparallel(benchmarkrun, tasks, workers):
+        print("Benchmarked " + " ".join(flag + " " + value for flag, value in zip(flags, task[0])) + (": failed" if result is None else ""),file=sys.stderr)
+        results[task[0]] = result
+
+    with io.open(outputdir + '/' + os.path.basename(trainfile).split('.')[0] + '.benchmark.csv','w',encoding='utf-8',newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(flags + ['training_time_s','classification_time_s','test_instances','instances_per_s','peak_rss_mb','accuracy'])
+        for task in tasks:
+            result = results[task[0]]
+            if result is None:
+                writer.writerow(list(task[0]) + ['failed'] + [''] * 5)
+            else:
+                traintime, testtime, rss, accuracy = result
+                writer.writerow(list(task[0]) + [round(traintime,3), round(testtime,3), testsize, round(testsize / testtime if testtime else 0,1), round(rss,1), '' if accuracy is None else round(accuracy,6)])
+    shutil.rmtree(benchmarkdir)
+
+
+if __name__ == "__main__":
+    statusfile = sys.argv[1]
+    inputdir = sys.argv[2]
+    outputdir = sys.argv[3]
+    options = parseoptions(sys.argv[4:])
+
+    doevaluate = any(flag == '--evaluate' for flag, _ in options)
+    if doevaluate and (getoption(options, '-F') or 'Columns') not in SEPARATORS:
+        print("Evaluation is not available for the " + getoption(options, '-F') + " format",file=sys.stderr)
+        doevaluate = False
+
+    #the cache of previously trained instance bases, shared with all other jobs of this service
+    cache = ResultCache(TIMBL_CACHE_DIR, TIMBL_CACHE_SIZE)
+
+    trainfile = None
+    for inputfile in glob.glob(inputdir + '/*.train'):
+        trainfile = inputfile
+
+    if not trainfile:
+        print("No trainfile found",file=sys.stderr)
+        sys.exit(1)
+
+    testfiles = glob.glob(inputdir + '/*.test')
+
+    if any(flag == '--benchmark' for flag, _ in options):
+        if getoption(options, '-F') == 'ARFF':
+            print("Benchmarking is not available for the ARFF format",file=sys.stderr)
+            sys.exit(1)
+        benchmark(trainfile, testfiles, options, outputdir)
+        sys.exit(0)
+
+    folds = int(getoption(options, '--folds') or 0)
+    leaveoneout = getoption(options, '-t') == 'leave_one_out'
+    if not testfiles and folds <= 1 and not leaveoneout:
+        #test data is optional for the modes that test on the training data only
+        print("No test files found; provide test data or select cross-validation, leave-one-out or benchmarking",file=sys.stderr)
+        sys.exit(1)
+
+    if testfiles:
+        #build the instance base (and compute the feature weights) only once, and classify all test files against it
+        prefix = outputdir + '/.' + os.path.basename(trainfile)
+        if not cachedtrain(cache, trainfile, options, prefix):
+            print("Training failed",file=sys.stderr)
+            sys.exit(1)
+
+        #every task starts a Timbl process that loads the instance base, a worker needs memory for one of them
+        workers = workercount(TIMBL_MAXWORKERS, 2 * os.path.getsize(prefix + '.ibase') // (1024*1024))
+
+        tasks = []
+        shards = {} #output file => sharding information for test files that are split into shards
+        testfilesbyoutput = {}
+        for testfile in testfiles:
+            outfile = outputdir + '/' + os.path.basename(testfile).split('.')[0] + '.timblout'
+            testfilesbyoutput[outfile] = testfile
+            if TIMBL_SHARDSIZE > 0 and workers > 1 and os.path.getsize(testfile) > TIMBL_SHARDSIZE and getoption(options, '-F') != 'ARFF':
+                #large test file: split it into line ranges that are classified in parallel and stitched back afterwards,
+                #one per worker, as every shard loads the instance base again
+                shardsdir = outputdir + '/.' + os.path.basename(outfile) + '.shards'
+                if not os.path.isdir(shardsdir):
+                    os.mkdir(shardsdir)
+                shardfiles = splittext(testfile, -(-os.path.getsize(testfile) // workers), shardsdir + '/shard', sentenceperline=True)
+                print("Split " + os.path.basename(testfile) + " into " + str(len(shardfiles)) + " shards",file=sys.stderr)
+                shards[outfile] = { 'dir': shardsdir, 'outputfiles': [ shardfile[:-4] + '.out' for shardfile in shardfiles ], 'remaining': len(shardfiles) }
+                for shardfile in shardfiles:
+                    tasks.append( (prefix, options, shardfile, shardfile[:-4] + '.out', outfile) )
+            else:
+                tasks.append( (prefix, options, testfile, outfile, None) )
+
+        workers = min(workers, len(tasks))
+        print("Classifying " + str(len(tasks)) + " file(s)/shard(s) using " + str(workers) + " worker(s)",file=sys.stderr)
 
-if parameters.find('-t leave_one_out') != -1:
-    print("Testing with leave-one-out",file=sys.stderr)
-    os.system('timbl -f ' + shellsafe(trainfile,"'") + ' ' + parameters + ' -o ' + shellsafe(outfile,"'"))
+        for task, success in runparallel(classify, tasks, workers):
+            if not success:
+                print("Testing " + task[2] + " failed",file=sys.stderr)
+                abort()
+                sys.exit(1)
+            outfile = task[3]
+            if task[4] is not None:
+                sharding = shards[task[4]]
+                sharding['remaining'] -= 1
+                if sharding['remaining'] > 0:
+                    continue
+                #all shards are done, stitch their output (in order) into the actual output file
+                concatenate(sharding['outputfiles'], task[4])
+                shutil.rmtree(sharding['dir'])
+                outfile = task[4]
+            if doevaluate:
+                writeevaluation(outfile[:-len('.timblout')], *evaluate(outfile, testfilesbyoutput[outfile], SEPARATORS[getoption(options, '-F') or 'Columns']))
 
+        for extension in ('.ibase','.wgt','.arr','.traintime'):
+            if os.path.exists(prefix + extension):
+                os.unlink(prefix + extension)
 
+    if cache.enabled():
+        print(cache.report(),file=sys.stderr)
 
+    if folds > 1:
+        if (getoption(options, '-F') or 'Columns') not in SEPARATORS:
+            print("Cross-validation is not available for the " + getoption(options, '-F') + " format",file=sys.stderr)
+            sys.exit(1)
+        if not crossvalidate(trainfile, options, folds, outputdir, doevaluate):
+            sys.exit(1)
 
+    if leaveoneout:
+        print("Testing with leave-one-out",file=sys.stderr)
+        outfile = outputdir + '/' + os.path.basename(trainfile).split('.')[0] + '.leaveoneout.timblout'
+        os.system('timbl -f ' + shellsafe(trainfile,"'") + ' ' + timblargs(options) + ' -o ' + shellsafe(outfile,"'"))
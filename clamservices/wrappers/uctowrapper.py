@@ -19,14 +19,81 @@ from __future__ import print_function, unicode_literals, division, absolute_impo
 #import some general python modules:
 import sys
 import os
+import io
+import re
+import shutil
 
 #import CLAM-specific modules. The CLAM API makes a lot of stuff easily accessible.
 import clam.common.data
 import clam.common.status
 from clam.common.util import makencname
 
+from clamservices.config.ucto import UCTO_INPROCESS, UCTO_MAXWORKERS, UCTO_CHUNKSIZE
+from clamservices.wrappers.parallel import workercount, runparallel, call, abort
+from clamservices.wrappers.sharding import splittext, mergefolia, concatenate
+
+try:
+    import ucto
+except ImportError:
+    ucto = None
+
 shellsafe = clam.common.data.shellsafe
 
+#Document ID the in-process tokenisers are initialised with, replaced by the actual document ID in the output
+INPROCESS_DOCID = "uctoinprocessdoc"
+
+tokenizers = {} #(language, outputtemplate) => ucto.Tokenizer, every worker process has its own
+
+def tokenise_inprocess(options, language, outputtemplate, inputfilepath, outputfilepath, docid=None):
+    """Tokenise a file in-process with the Python ucto bindings, using the same options as the ucto executable would get. Returns True on success."""
+    key = (language, outputtemplate)
+    if key not in tokenizers:
+        print("Initialising tokeniser for " + language,file=sys.stderr)
+        tokenizers[key] = ucto.Tokenizer("tokconfig-" + language,
+            lowercase=options['lowercase'],
+            uppercase=options['uppercase'],
+            sentenceperlineoutput=options['sentenceperline'],
+            xmloutput=(outputtemplate == 'foliatokoutput'),
+            docid=INPROCESS_DOCID)
+    try:
+        tokenizers[key].tokenize(inputfilepath, outputfilepath)
+    except Exception as e: #pylint: disable=broad-except
+        print("Error tokenising " + inputfilepath + ": " + str(e),file=sys.stderr)
+        return False
+    if docid is not None:
+        #set the actual document ID
+        idpattern = re.compile(r'((?:xml:)?id=")' + INPROCESS_DOCID + r'(?=[."])')
+        with io.open(outputfilepath,'r',encoding='utf-8') as f, io.open(outputfilepath + ".tmp",'w',encoding='utf-8') as out:
+            for line in f:
+                out.write(idpattern.sub(lambda m: m.group(1) + docid, line))
+        os.rename(outputfilepath + ".tmp", outputfilepath)
+    return True
+
+def tokenise(task):
+    """Produce a single output file, returns True on success. Runs in a worker (thread or process)."""
+    bindir, inprocess, options, commandlineargs, outputtemplate, language, inputfilepath, outputfilepath, docid, _ = task
+
+    #Which outputtemplate are we processing?
+    if outputtemplate == 'foliatokoutput':
+        #FoLiA XML output
+        if inprocess:
+            return tokenise_inprocess(options, language, outputtemplate, inputfilepath, outputfilepath, docid)
+        return call(os.path.join(bindir,'ucto') + ' -L ' + shellsafe(language,"'") + ' -X --id=' +
+                  shellsafe(docid,"'") + ' ' + commandlineargs + ' ' +
+                  shellsafe(inputfilepath,'"') +  ' ' + shellsafe(outputfilepath,'"')) == 0
+    elif outputtemplate == 'vtokoutput':
+        #Verbose output
+        return call(os.path.join(bindir,'ucto') + ' -L ' + shellsafe(language,"'")+ ' ' +
+                  commandlineargs + ' ' + shellsafe(inputfilepath,'"') +
+                 ' > ' + shellsafe(outputfilepath,'"')) == 0
+    elif outputtemplate == 'tokoutput':
+        #plain text output
+        if inprocess:
+            return tokenise_inprocess(options, language, outputtemplate, inputfilepath, outputfilepath)
+        return call(os.path.join(bindir,'ucto') + ' -L ' + shellsafe(language,"'")+ ' ' +
+                  commandlineargs + ' ' + shellsafe(inputfilepath,'"') +
+                  ' > ' + shellsafe(outputfilepath,'"')) == 0
+
 if __name__ == "__main__":
 
     #this script takes four arguments from CLAM: $BINDIR $DATAFILE $STATUSFILE $OUTPUTDIRECTORY  (as configured at COMMAND= in the service configuration file)
@@ -47,50 +114,73 @@ if __name__ == "__main__":
     #Obtain all parameters, along with their flags, as a string suitable to pass to the tool, this is shell-safe by definition
     commandlineargs = clamdata.commandlineargs()
 
-    l = len(clamdata.program) #total amount of output files, for computation of progress
-    for i, (outputfile, outputtemplate) in enumerate(clamdata.program.getoutputfiles()):
-        if outputtemplate in ('foliatokoutput','vtokoutput','tokoutput'):
-            #Get path+filename for the outputfile
-            outputfilepath = str(outputfile)
+    inprocess = UCTO_INPROCESS and ucto is not None
+    if UCTO_INPROCESS and not inprocess:
+        print("Python ucto bindings not available, falling back to the ucto executable",file=sys.stderr)
 
-            #Update our status message to let CLAM know what we're doing
-            clam.common.status.write(statusfile, "Producing " + os.path.basename(outputfilepath) + "...", round((i/l)*100))
+    #the options for the in-process tokenisers
+    options = dict( (option, option in clamdata and bool(clamdata[option])) for option in ('lowercase','uppercase','sentenceperline') )
 
+    tasks = []
+    chunks = {} #output file => chunking information for documents that are split into chunks
+    for outputfile, outputtemplate in clamdata.program.getoutputfiles():
+        if outputtemplate in ('foliatokoutput','vtokoutput','tokoutput'):
             #We need one of the metadata fields (inherited from the input data), all of the output templates we defined have this parameter
             language = outputfile.metadata['language']
 
             #We have a one-one relationship between inputfiles and outputfiles, so we can grab the input file here:
             inputfile, inputtemplate = clamdata.program.getinputfile(outputfile)
 
-            #Which outputtemplate are we processing?
+            docid = None
             if outputtemplate == 'foliatokoutput':
-                #FoLiA XML output
-                docid = None
                 if 'documentid' in inputfile.metadata and inputfile.metadata['documentid']:
                     docid = inputfile.metadata['documentid']
                 else:
                     docid = makencname(os.path.basename(str(inputfile)).replace(".txt","").replace(".folia.xml","").replace(".xml",""))
                 if not docid:
                     docid = "untitled"
-                if os.system(os.path.join(bindir,'ucto') + ' -L ' + shellsafe(language,"'") + ' -X --id=' +
-                          shellsafe(docid,"'") + ' ' + commandlineargs + ' ' +
-                          shellsafe(str(inputfile),'"') +  ' ' + shellsafe(outputfilepath,'"')) != 0:
-                    clam.common.status.write(statusfile, "Failed",100) # status update
-                    sys.exit(1)
-            elif outputtemplate == 'vtokoutput':
-                #Verbose output
-                if os.system(os.path.join(bindir,'ucto') + ' -L ' + shellsafe(language,"'")+ ' ' +
-                          commandlineargs + ' ' + shellsafe(str(inputfile),'"') +
-                         ' > ' + shellsafe(outputfilepath,'"')) != 0:
-                    clam.common.status.write(statusfile, "Failed",100) # status update
-                    sys.exit(1)
-            elif outputtemplate == 'tokoutput':
-                #plain text output
-                if os.system(os.path.join(bindir,'ucto') + ' -L ' + shellsafe(language,"'")+ ' ' +
-                          commandlineargs + ' ' + shellsafe(str(inputfile),'"') +
-                          ' > ' + shellsafe(outputfilepath,'"'))  != 0:
-                    clam.common.status.write(statusfile, "Failed",100) # status update
-                    sys.exit(1)
+
+            if UCTO_CHUNKSIZE > 0 and os.path.getsize(str(inputfile)) > UCTO_CHUNKSIZE:
+                #large document: split at paragraph boundaries into chunks that are tokenised in parallel and merged afterwards
+                chunksdir = os.path.join(outputdir, "." + os.path.basename(str(outputfile)) + ".chunks")
+                if not os.path.isdir(chunksdir):
+                    os.mkdir(chunksdir)
+                chunkfiles = splittext(str(inputfile), UCTO_CHUNKSIZE, os.path.join(chunksdir, "chunk"))
+                print("Split " + os.path.basename(str(inputfile)) + " into " + str(len(chunkfiles)) + " chunks",file=sys.stderr)
+                chunks[str(outputfile)] = { 'dir': chunksdir, 'outputfiles': [ chunkfile[:-4] + ".out" for chunkfile in chunkfiles ], 'remaining': len(chunkfiles), 'docid': docid, 'outputtemplate': outputtemplate }
+                for chunkfile in chunkfiles:
+                    tasks.append( (bindir, inprocess, options, commandlineargs, outputtemplate, language, chunkfile, chunkfile[:-4] + ".out", docid, str(outputfile)) )
+            else:
+                tasks.append( (bindir, inprocess, options, commandlineargs, outputtemplate, language, str(inputfile), str(outputfile), docid, None) )
+
+    #Output files are independent of each other, produce them in parallel. In-process tokenisation runs in worker
+    #processes (each with its own tokenisers), otherwise threads suffice as the actual work is done by ucto processes
+    #(verbose output is always produced by the ucto executable)
+    workers = workercount(UCTO_MAXWORKERS, 0, len(tasks))
+    processes = inprocess and workers > 1 and any(task[4] != 'vtokoutput' for task in tasks)
+    print("Producing " + str(len(tasks)) + " file(s)/chunk(s) using " + str(workers) + " worker " + ("process(es)" if processes else "thread(s)"),file=sys.stderr)
+
+    done = 0
+    for task, success in runparallel(tokenise, tasks, workers, processes=processes):
+        if not success:
+            print("Failed to produce " + os.path.basename(task[7]),file=sys.stderr)
+            abort()
+            clam.common.status.write(statusfile, "Failed",100) # status update
+            sys.exit(1)
+        done += 1
+        #Update our status message to let CLAM know what we're doing
+        clam.common.status.write(statusfile, "Produced " + os.path.basename(task[7]) + " (" + str(done) + " of " + str(len(tasks)) + ")", round((done/len(tasks))*100))
+        if task[9] is not None:
+            chunking = chunks[task[9]]
+            chunking['remaining'] -= 1
+            if chunking['remaining'] == 0:
+                #all chunks are done, merge them (in order) into the actual output file
+                print("Merging " + str(len(chunking['outputfiles'])) + " chunks into " + os.path.basename(task[9]),file=sys.stderr)
+                if chunking['outputtemplate'] == 'foliatokoutput':
+                    mergefolia(chunking['outputfiles'], task[9], chunking['docid'])
+                else:
+                    concatenate(chunking['outputfiles'], task[9])
+                shutil.rmtree(chunking['dir'])
 
     #A nice status message to indicate we're done
     clam.common.status.write(statusfile, "Done",100) # status update